@@ -0,0 +1,34 @@
+import argparse
+import gc
+import time
+import tracemalloc
+
+from ip_app import app, session, User, UserRow, user_columns, to_rows
+
+
+def measure(name, load):
+    session.expunge_all()
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    rows = load()
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:<12} rows: {:>7}  time: {:>8.1f} ms  retained: {:>9.1f} KiB  peak: {:>9.1f} KiB'.format(
+        name, len(rows), elapsed * 1000, current / 1024, peak / 1024))
+    del rows
+    session.expunge_all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare memory used by ORM entities and projection rows')
+    parser.add_argument('-n', '--rows', type=int, default=10000, help='Number of users to load')
+    args = parser.parse_args()
+    with app.app_context():
+        measure('orm', lambda: session.query(User).limit(args.rows).all())
+        measure('projection', lambda: to_rows(UserRow, session.query(*user_columns).limit(args.rows).all()))
+
+
+if __name__ == '__main__':
+    main()
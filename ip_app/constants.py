@@ -15,3 +15,7 @@ PHONE_REGEX = r'^[0-9]{10}$'
 sex_choices = ('F', 'M')
 sender_choices = ('TEACHER', 'STUDENT')
 hw_statuses = ('IN_PROGRESS', 'PENDING', 'APPROVED', 'NOT_APPROVED')
+job_statuses = ('PENDING', 'RUNNING', 'DONE', 'FAILED')
+metric_granularities = ('HOUR', 'DAY')
+statistics_names = ('registered_students', 'pending_applications', 'studying', 'teachers', 'revenue',
+                    'payed_orders')
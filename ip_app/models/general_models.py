@@ -1,21 +1,29 @@
 from ip_app import db
 from ip_app.constants import roles, user_statuses, order_statuses, discount_types, \
-    sex_choices, sender_choices, hw_statuses
+    sex_choices, sender_choices, hw_statuses, job_statuses, metric_granularities
 from sqlalchemy.dialects.mysql import INTEGER, SMALLINT
 
 
 class UserRegistration(db.Model):
     __tablename__ = 'users_registration'
+    __table_args__ = (
+        db.Index('registration_date_index', 'date'),
+    )
     email = db.Column(db.String(30), primary_key=True)
     hash = db.Column(db.String(36), nullable=False, unique=True)
     date = db.Column(db.DateTime, server_default=db.func.now())
     name = db.Column(db.String(30))
     last_name = db.Column(db.String(30))
     phone = db.Column(db.String(10))
+    last_email_date = db.Column(db.DateTime)
 
 
 class User(db.Model):
     __tablename__ = 'users'
+    __table_args__ = (
+        db.Index('user_registration_date_index', 'registration_date', 'user_id'),
+        db.Index('user_status_role_index', 'status', 'role'),
+    )
     user_id = db.Column(INTEGER(unsigned=True), primary_key=True)
     email = db.Column(db.String(30), nullable=False, unique=True)
     role = db.Column(db.Enum(*roles), nullable=False, server_default=roles[-1])
@@ -59,6 +67,7 @@ class Course(db.Model):
     course_pic_url = db.Column(db.String(100))
     author_name = db.Column(db.String(30), nullable=True)
     landing_info = db.Column(db.JSON, default={})
+    video_count = db.Column(db.Integer, nullable=False, server_default='0', default=0)
 
     teachers = db.relationship(
         User,
@@ -69,12 +78,18 @@ class Course(db.Model):
 
 class Order(db.Model):
     __tablename__ = 'orders'
+    __table_args__ = (
+        db.Index('order_user_status_index', 'user_id', 'status', 'order_id'),
+        db.Index('order_status_index', 'status', 'order_id'),
+        db.Index('order_date_index', 'order_date'),
+    )
     order_id = db.Column(INTEGER(unsigned=True), primary_key=True)
     user_id = db.Column(INTEGER(unsigned=True), db.ForeignKey('users.user_id', ondelete='SET NULL'), nullable=True)
     payment_link = db.Column(db.String(150))
     price = db.Column(INTEGER(unsigned=True))
     promocode = db.Column(db.String(20))
     status = db.Column(db.Enum(*order_statuses), default=order_statuses[0])
+    order_date = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
 
     user = db.relationship(User, backref='orders')
 
@@ -108,6 +123,17 @@ class ServiceProduct(db.Model):
     course = db.relationship(Course, backref=db.backref('service_products', cascade="all, delete"))
 
 
+class PromoCode(db.Model):
+    __tablename__ = 'promocodes'
+    promocode = db.Column(db.String(20), primary_key=True)
+    discount = db.Column(INTEGER(unsigned=True), nullable=False)
+    discount_type = db.Column(db.Enum(*discount_types), nullable=False, default=discount_types[0])
+    # Applies to products of this course only, to the whole cart if NULL
+    course_id = db.Column(INTEGER(unsigned=True), db.ForeignKey('courses.course_id', ondelete="CASCADE"),
+                          nullable=True)
+    end_date = db.Column(db.DateTime)
+
+
 class OrderCourseProductItem(db.Model):
     __tablename__ = 'course_pr_items'
     item_id = db.Column(INTEGER(unsigned=True), primary_key=True)
@@ -166,6 +192,7 @@ class Access(db.Model):
         db.UniqueConstraint('user_id', 'video_id',
                             name='unique_access_entry'),
         db.Index('access_date_index', 'begin_date', 'end_date'),
+        db.Index('access_user_date_index', 'user_id', 'begin_date', 'end_date'),
     )
     access_id = db.Column(INTEGER(unsigned=True), primary_key=True)
     user_id = db.Column(INTEGER(unsigned=True), db.ForeignKey('users.user_id', ondelete="CASCADE"), nullable=False)
@@ -193,7 +220,8 @@ class CourseProgressTracking(db.Model):
                                       ondelete="CASCADE"),
                         nullable=False)
     progress_percent = db.Column(db.Integer, server_default='0')
-    video_count = db.Column(db.Integer, server_default='0')
+    # Number of course videos the user has access to, maintained on access grant
+    video_count = db.Column(db.Integer, server_default='0', default=0)
 
 
 class VideoProgressTracking(db.Model):
@@ -236,6 +264,7 @@ class Chat(db.Model):
     __table_args__ = (
         db.UniqueConstraint('student_id', 'course_id',
                             name='unique_chat_entry'),
+        db.Index('chat_course_date_index', 'course_id', 'last_message_date'),
     )
     chat_id = db.Column(INTEGER(unsigned=True), primary_key=True)
     student_id = db.Column(INTEGER(unsigned=True),
@@ -265,6 +294,10 @@ class ChatThread(db.Model):
                          )
     teacher_read = db.Column(db.Boolean, server_default='1')
     student_read = db.Column(db.Boolean, server_default='0')
+    # Denormalized info about the last chat line, updated in create_chat_line
+    last_chat_line_id = db.Column(INTEGER(unsigned=True))
+    last_sender = db.Column(db.Enum(*sender_choices))
+    last_message_date = db.Column(db.DateTime)
     chat = db.relationship(Chat, backref=db.backref('chat_threads',
                                                     cascade="all, delete"))
 
@@ -273,6 +306,9 @@ class ChatThread(db.Model):
 
 class ChatLine(db.Model):
     __tablename__ = 'hw_chat_lines'
+    __table_args__ = (
+        db.Index('chat_line_thread_index', 'chat_thread_id', 'chat_line_id'),
+    )
     chat_line_id = db.Column(INTEGER(unsigned=True), primary_key=True)
     message = db.Column(db.String(300))
     message_date = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
@@ -297,3 +333,34 @@ class Statistics(db.Model):
     __tablename__ = 'statistics'
     statistics_name = db.Column(db.String(30), primary_key=True)
     value = db.Column(INTEGER(unsigned=True))
+
+
+class MetricRollup(db.Model):
+    __tablename__ = 'metric_rollups'
+    metric_name = db.Column(db.String(30), primary_key=True)
+    granularity = db.Column(db.Enum(*metric_granularities), primary_key=True)
+    period_start = db.Column(db.DateTime, primary_key=True)
+    # Last snapshot value in the period
+    value = db.Column(db.BigInteger, nullable=False)
+
+
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('job_status_run_at_index', 'status', 'run_at'),
+    )
+    job_id = db.Column(INTEGER(unsigned=True), primary_key=True)
+    job_type = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.JSON, default={})
+    status = db.Column(db.Enum(*job_statuses), nullable=False, default=job_statuses[0])
+    attempts = db.Column(SMALLINT(unsigned=True), nullable=False, default=0)
+    run_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+    locked_until = db.Column(db.DateTime)
+    created_date = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+    last_error = db.Column(db.String(300))
+
+
+class JobTypeLock(db.Model):
+    __tablename__ = 'job_type_locks'
+    # One row per job type, locked while a job of this type is being claimed
+    job_type = db.Column(db.String(50), primary_key=True)
@@ -1,12 +1,14 @@
+import os
 from functools import wraps
 
 from flask_restx import Resource, inputs
 from werkzeug.datastructures import FileStorage
 
-from ip_app import api, check_last_seen, add_progress_percent, get_chat_items_by_chat_id, ImageLoader, FlaskAdapter
+from ip_app import api, check_last_seen, get_chat_items_by_chat_id, ImageLoader, FlaskAdapter, \
+    UserRow, CourseRow, to_rows, payment_gateway, UploadValidationError
 from ip_app.models import User, CourseApplication, Course
 from flask import request, g, send_file
-from ip_app.constants import roles
+from ip_app.constants import roles, metric_granularities, order_statuses
 from ip_app.service import services
 from ip_app.serializers.serializers import user_model_with_token, user_model_base, credentials_model, \
     user_model_with_credentials, payment_link_model, cart_model, course_landing_model, \
@@ -14,7 +16,8 @@ from ip_app.serializers.serializers import user_model_with_token, user_model_bas
     contacts_info_model, legal_info_model, statistics_model, course_application_model, first_step_registration_model, \
     user_model_patch, course_patch_model, video_progress_model, chat_line_model, chat_with_teacher_read_model, \
     chat_teacher_model, user_model_with_course, chat_thread_model, teacher_model_with_courses_count, \
-    teacher_model_with_courses, notifications_model, file_model
+    teacher_model_with_courses, notifications_model, file_model, chat_events_model, unread_counters_model, \
+    metric_rollup_model, registration_resend_model, payment_gateway_metrics_model, cart_quote_model, order_model
 from ip_app.utils import PaginationMixin
 
 aut_nsp = api.namespace('Authentication', path='/auth', description='Operations related to authentication')
@@ -146,10 +149,9 @@ class ActiveUserCollection(Resource, PaginationMixin):
         """
         Get multiple users with active course
         """
-        return services.add_field_to_obj(
+        return services.add_course_to_user(
             self.paginate(users_parser.parse_args(),
-                          query=services.get_multiple_users_with_course_for_current_user()),
-            'course')
+                          query=services.get_multiple_users_with_course_for_current_user()))
 
 
 teachers_parser = pagination_parser.copy()
@@ -175,11 +177,10 @@ class TeacherCollection(Resource, PaginationMixin):
         course_ids = args.pop('courses', None)
         if course_ids is not None:
             course_ids = course_ids.split(',')
-        return services.add_field_to_obj(
-            self.paginate(args,
-                          query=services.get_multiple_teachers_with_courses(
-                              course_ids)),
-            'courses_count')
+        return to_rows(UserRow,
+                       self.paginate(args,
+                                     query=services.get_multiple_teachers_with_courses(
+                                         course_ids)))
 
 
 @usr_nsp.route('/teachers/<int:teacher_id>')
@@ -306,7 +307,20 @@ registration_user_parser = api.parser()
 registration_user_parser.add_argument('hash', help='Unique registration user hash', location='args')
 
 
-# TODO API for sending email with hash
+@usr_nsp.route('/registration_init/resend')
+class RegistrationResend(Resource):
+    """
+    Resend email with registration hash
+    """
+
+    @api.expect(registration_resend_model)
+    @api.doc(security=None)
+    def post(self):
+        """
+        Always succeeds, the email is sent only to pending registrations and not more often than allowed
+        """
+        services.resend_registration_email(request.get_json()['email'])
+        return {}
 
 
 @usr_nsp.route('/check')
@@ -486,9 +500,9 @@ class AvailableCourseCollection(Resource, PaginationMixin):
         Get courses available to the current user
         """
         # TODO: sorting b
-        return add_progress_percent(self.paginate(pagination_parser.parse_args(),
-                                                  query=services.get_available_courses_as_query_for_student(
-                                                      g.current_user)))
+        return to_rows(CourseRow, self.paginate(pagination_parser.parse_args(),
+                                                query=services.get_available_courses_as_query_for_student(
+                                                    g.current_user)))
 
 
 @crs_nsp.route('/available/<int:course_id>')
@@ -539,9 +553,37 @@ class ChatsCollection(Resource):
         return message
 
 
+@cht_nsp.route('/unread')
+class ChatsUnreadCounters(Resource):
+    @role_required()
+    @api.marshal_with(unread_counters_model)
+    def get(self):
+        """
+        Get numbers of unread chat threads for user
+        """
+        return services.get_unread_counters(g.current_user, 'STUDENT')
+
+
+@cht_nsp.route('/teacher/unread')
+class ChatsTeacherUnreadCounters(Resource):
+    @role_required(1)
+    @api.marshal_with(unread_counters_model)
+    def get(self):
+        """
+        Get numbers of unread chat threads for teacher
+        """
+        return services.get_unread_counters(g.current_user, 'TEACHER')
+
+
+chat_threads_parser = api.parser()
+chat_threads_parser.add_argument('size', type=inputs.int_range(1, 100), help='Number of last chat lines per thread',
+                                 default=None, location='args')
+
+
 @cht_nsp.route('/<int:chat_id>')
 class ChatItem(Resource):
     @role_required()
+    @api.expect(chat_threads_parser)
     @api.marshal_list_with(chat_thread_model)
     @api.response(404, 'Chat not found')
     @api.response(403, 'Access denied')
@@ -549,27 +591,35 @@ class ChatItem(Resource):
         """
         Get chat threads by chat_id
         """
-        ok, chat_items = get_chat_items_by_chat_id(g.current_user, chat_id, 'STUDENT')
+        ok, chat_items = get_chat_items_by_chat_id(g.current_user, chat_id, 'STUDENT',
+                                                   **chat_threads_parser.parse_args())
         if not ok:
             status, response = chat_items
             api.abort(status, response)
         return chat_items
 
 
+teacher_chats_parser = pagination_parser.copy()
+teacher_chats_parser.add_argument('unread', type=inputs.boolean, help='Only chats with unread messages',
+                                  default=False, location='args')
+
+
 @cht_nsp.route('/teacher')
 class ChatsTeacherCollection(Resource):
     @role_required(1)
+    @api.expect(teacher_chats_parser)
     @api.marshal_list_with(chat_teacher_model)
     def get(self):
         """
-        Get chats for teacher
+        Get chats for teacher grouped by course (pagination is applied to each course)
         """
-        return services.get_chats_for_teacher(g.current_user)
+        return services.get_chats_for_teacher(g.current_user, **teacher_chats_parser.parse_args())
 
 
 @cht_nsp.route('/teacher/<int:chat_id>')
 class ChatTeacherItem(Resource):
     @role_required(1)
+    @api.expect(chat_threads_parser)
     @api.marshal_list_with(chat_thread_model)
     @api.response(404, 'Chat not found')
     @api.response(403, 'Access denied')
@@ -577,13 +627,56 @@ class ChatTeacherItem(Resource):
         """
         Get chat threads by chat_id for teacher
         """
-        ok, chat_items = get_chat_items_by_chat_id(g.current_user, chat_id, 'TEACHER')
+        ok, chat_items = get_chat_items_by_chat_id(g.current_user, chat_id, 'TEACHER',
+                                                   **chat_threads_parser.parse_args())
         if not ok:
             status, response = chat_items
             api.abort(status, response)
         return chat_items
 
 
+chat_lines_parser = chat_threads_parser.copy()
+chat_lines_parser.add_argument('before', type=inputs.positive, help='Return chat lines older than this chat_line_id',
+                               default=None, location='args')
+
+
+@cht_nsp.route('/thread/<int:chat_thread_id>')
+class ChatThreadLines(Resource):
+    @role_required()
+    @api.expect(chat_lines_parser)
+    @api.marshal_list_with(chat_line_model)
+    @api.response(404, 'Chat thread not found')
+    @api.response(403, 'Access denied')
+    def get(self, chat_thread_id):
+        """
+        Get older chat lines of a chat thread
+        """
+        ok, chat_lines = services.get_chat_lines(g.current_user, chat_thread_id, **chat_lines_parser.parse_args())
+        if not ok:
+            status, response = chat_lines
+            api.abort(status, response)
+        return chat_lines
+
+
+chat_events_parser = api.parser()
+chat_events_parser.add_argument('since', type=inputs.natural, help='Last known event_id, defaults to the latest',
+                                default=None, location='args')
+chat_events_parser.add_argument('timeout', type=inputs.positive, help='Seconds to wait for new messages',
+                                default=None, location='args')
+
+
+@cht_nsp.route('/events')
+class ChatEvents(Resource):
+    @role_required()
+    @api.expect(chat_events_parser)
+    @api.marshal_with(chat_events_model)
+    def get(self):
+        """
+        Wait for new messages in chats of the current user (long poll)
+        """
+        return services.wait_for_chat_events(g.current_user, **chat_events_parser.parse_args())
+
+
 @cht_nsp.route('/notifications')
 class ChatsNotificationsCollection(Resource):
     @role_required()
@@ -632,6 +725,7 @@ class ChatsNotificationsCollection(Resource):
 class CardPayment(Resource):
     @api.expect(cart_model)
     @api.response(404, 'Product(s) not found')
+    @api.response(400, 'Invalid promocode')
     @api.response(503, 'Payment operational error')
     @api.response(403, 'Access denied')
     @api.response(400, 'Cart is empty')
@@ -648,9 +742,78 @@ class CardPayment(Resource):
         return order
 
 
+orders_parser = api.parser()
+orders_parser.add_argument('status', choices=order_statuses, default=None, location='args')
+orders_parser.add_argument('begin_date', type=inputs.datetime_from_iso8601, default=None, location='args')
+orders_parser.add_argument('end_date', type=inputs.datetime_from_iso8601, default=None, location='args')
+orders_parser.add_argument('before', type=inputs.positive, help='Return orders older than this order_id',
+                           default=None, location='args')
+orders_parser.add_argument('size', type=inputs.int_range(1, 500), help='Orders per page', default=None,
+                           location='args')
+
+all_orders_parser = orders_parser.copy()
+all_orders_parser.add_argument('user_id', type=inputs.positive, default=None, location='args')
+
+
+@pmt_nsp.route('/orders')
+class OrdersCollection(Resource):
+    @api.expect(orders_parser)
+    @api.marshal_list_with(order_model)
+    @role_required()
+    def get(self):
+        """
+        Get order history of the current user, newest first
+        """
+        return services.get_orders(user_id=g.current_user.user_id, **orders_parser.parse_args())
+
+
+@pmt_nsp.route('/orders/all')
+class AllOrdersCollection(Resource):
+    @api.expect(all_orders_parser)
+    @api.marshal_list_with(order_model)
+    @api.response(403, 'Access denied')
+    @role_required(0)
+    def get(self):
+        """
+        Get orders of all users, newest first
+        """
+        return services.get_orders(**all_orders_parser.parse_args())
+
+
+@pmt_nsp.route('/quote')
+class CartQuote(Resource):
+    @api.expect(cart_model)
+    @api.response(404, 'Product(s) not found')
+    @api.response(400, 'Invalid promocode')
+    @api.marshal_with(cart_quote_model)
+    @api.doc(security=None)
+    def post(self):
+        """
+        Calculate cart price with discounts and promocode
+        """
+        ok, quote = services.get_cart_quote(request.get_json())
+        if not ok:
+            status, reason = quote
+            api.abort(status, reason)
+        return quote
+
+
+@pmt_nsp.route('/gateway')
+class PaymentGatewayMetrics(Resource):
+    @api.marshal_with(payment_gateway_metrics_model)
+    @api.response(403, 'Access denied')
+    @role_required(0)
+    def get(self):
+        """
+        Get payment gateway request metrics and circuit breaker state
+        """
+        return payment_gateway.get_metrics()
+
+
 @pmt_nsp.route('/callback/<int:order_id>')
 class PaymentCallback(Resource):
     @api.response(404, 'Order not found')
+    @api.response(409, 'Order is not awaiting payment')
     @api.doc(security=None)
     def get(self, order_id):
         """
@@ -742,6 +905,34 @@ class Statistics(Resource):
         return services.get_statistics()
 
 
+metrics_parser = api.parser()
+metrics_parser.add_argument('metrics', help='Comma separated metric names', default=None, location='args')
+metrics_parser.add_argument('granularity', choices=metric_granularities, default='DAY', location='args')
+metrics_parser.add_argument('begin_date', type=inputs.datetime_from_iso8601, default=None, location='args')
+metrics_parser.add_argument('end_date', type=inputs.datetime_from_iso8601, default=None, location='args')
+
+
+@stc_nsp.route('/history')
+class StatisticsHistory(Resource):
+    """
+    Sales and users statistics history
+    """
+
+    @api.expect(metrics_parser)
+    @api.marshal_list_with(metric_rollup_model)
+    @api.response(403, 'Access denied')
+    @role_required(0)
+    def get(self):
+        """
+        Get hourly or daily statistics values for a date range
+        """
+        args = metrics_parser.parse_args()
+        metric_names = args.pop('metrics')
+        if metric_names is not None:
+            metric_names = metric_names.split(',')
+        return services.get_metric_rollups(metric_names, **args)
+
+
 file_parser = api.parser()
 file_parser.add_argument('file', type=FileStorage, location='files')
 
@@ -754,26 +945,34 @@ class Files(Resource):
     @api.expect(file_parser)
     @api.marshal_with(file_model)
     @api.response(403, 'Access denied')
+    @api.response(400, 'File does not meet the validation')
     @role_required()
     def post(self):
         """
         Save file
         """
-        file_path = ImageLoader.upload(FlaskAdapter(request), "img", options={
-            'fieldname': 'file'
-        })
+        try:
+            file_path = ImageLoader.upload(FlaskAdapter(request), "img", options={
+                'fieldname': 'file'
+            })
+        except UploadValidationError as e:
+            api.abort(400, str(e))
         return file_path
 
 
-@fls_nsp.route('/<file_id>')
+@fls_nsp.route('/<path:file_id>')
 class FilesGetter(Resource):
 
+    @api.response(404, 'File not found')
     def get(self, file_id):
         """
         Get file by id
         """
+        file_path = ImageLoader.get_file(file_id)
+        if file_path is None or not os.path.isfile(file_path):
+            api.abort(404, 'File not found')
         return send_file(
-            ImageLoader.get_file(file_id),
+            file_path,
             cache_timeout=0,
             as_attachment=True
     )
\ No newline at end of file
@@ -1,7 +1,7 @@
 from flask_restx import fields
 from ip_app import api
 from ip_app.constants import roles, user_statuses, course_statuses, video_statuses, EMAIL_REGEX, PHONE_REGEX, \
-    sex_choices, hw_statuses, sender_choices
+    sex_choices, hw_statuses, sender_choices, metric_granularities, order_statuses
 
 
 class Email(fields.String):
@@ -52,6 +52,10 @@ first_step_registration_model = api.model('Check user model', {
     'last_name': fields.String(min_length=1),
 })
 
+registration_resend_model = api.model('Registration email resend', {
+    'email': Email(required=True),
+})
+
 user_model_base = api.clone('User model base', short_user_model, {
     'email': Email(readonly=True),
     'phone': PhoneNumber,
@@ -253,12 +257,66 @@ payment_link_model = api.model('Payment link model', {
     'payment_link': fields.String,
 })
 
+payment_gateway_metrics_model = api.model('Payment gateway metrics', {
+    'requests': fields.Integer,
+    'failures': fields.Integer,
+    'rejected': fields.Integer(description='Calls rejected while the circuit was open or all connections were busy'),
+    'average_ms': fields.Float,
+    'max_ms': fields.Float,
+    'circuit': fields.String(enum=['CLOSED', 'OPEN', 'HALF_OPEN']),
+})
+
 cart_model = api.model('Order cart', {
     'promocode': fields.String,
     'course_product_ids': fields.List(fields.Integer(min=1), default=[]),
     'service_product_ids': fields.List(fields.Integer(min=1), default=[]),
 })
 
+course_product_quote_model = api.model('Course product quote', {
+    'course_product_id': fields.Integer,
+    'price': fields.Integer,
+    'discounted_price': fields.Integer,
+})
+
+service_product_quote_model = api.model('Service product quote', {
+    'service_product_id': fields.Integer,
+    'price': fields.Integer,
+    'discounted_price': fields.Integer,
+})
+
+cart_quote_model = api.model('Cart quote', {
+    'course_products': fields.List(fields.Nested(course_product_quote_model)),
+    'service_products': fields.List(fields.Nested(service_product_quote_model)),
+    'price': fields.Integer(description='Price without discounts'),
+    'discount': fields.Integer(description='Product discounts and promocode discount'),
+    'total': fields.Integer,
+    'promocode': fields.String,
+})
+
+order_course_product_item_model = api.model('Order course product item', {
+    'item_id': fields.Integer,
+    'course_product_id': fields.Integer,
+    'price': fields.Integer,
+})
+
+order_service_product_item_model = api.model('Order service product item', {
+    'item_id': fields.Integer,
+    'service_product_id': fields.Integer,
+    'price': fields.Integer,
+})
+
+order_model = api.model('Order', {
+    'order_id': fields.Integer,
+    'user_id': fields.Integer,
+    'status': fields.String(enum=order_statuses),
+    'price': fields.Integer,
+    'promocode': fields.String,
+    'order_date': fields.DateTime,
+    'payment_link': fields.String,
+    'course_product_items': fields.List(fields.Nested(order_course_product_item_model)),
+    'service_product_items': fields.List(fields.Nested(order_service_product_item_model)),
+})
+
 contacts_info_model = api.model('Contacts info', {
     'phone_number': PhoneNumber,
     'whatsapp': fields.String,
@@ -280,6 +338,15 @@ statistics_model = api.model('Statistics', {
     'pending_applications': fields.Integer,
     'studying': fields.Integer,
     'teachers': fields.Integer,
+    'revenue': fields.Integer,
+    'payed_orders': fields.Integer,
+})
+
+metric_rollup_model = api.model('Metric rollup', {
+    'metric_name': fields.String,
+    'granularity': fields.String(enum=metric_granularities),
+    'period_start': fields.DateTime,
+    'value': fields.Integer(description='Last value in the period'),
 })
 
 course_application_model = api.model('Course application', {
@@ -337,11 +404,40 @@ notifications_model = api.model('Notifications model', {
 
 chat_thread_model = api.model('Chat thread model', {
     'chat_thread_id': fields.Integer,
-    'chat_lines': fields.List(fields.Nested(chat_line_model)),
+    'chat_lines': fields.List(fields.Nested(chat_line_model), attribute='recent_chat_lines'),
     'hw_status': fields.String(enum=hw_statuses),
     'video': fields.Nested(video_base_model)
 })
 
+chat_event_model = api.model('Chat event model', {
+    'event_id': fields.Integer(description='chat_line_id of the new message'),
+    'chat_id': fields.Integer,
+    'chat_thread_id': fields.Integer,
+    'course_id': fields.Integer,
+    'student_id': fields.Integer,
+    'sender': fields.String(enum=sender_choices),
+})
+
+chat_events_model = api.model('Chat events model', {
+    'last_event_id': fields.Integer(description='Cursor for the next request'),
+    'events': fields.List(fields.Nested(chat_event_model)),
+})
+
+unread_course_model = api.model('Unread threads in course', {
+    'course_id': fields.Integer,
+    'unread_threads': fields.Integer,
+})
+
+unread_chat_model = api.clone('Unread threads in chat', unread_course_model, {
+    'chat_id': fields.Integer,
+})
+
+unread_counters_model = api.model('Unread counters', {
+    'unread_threads': fields.Integer,
+    'courses': fields.List(fields.Nested(unread_course_model)),
+    'chats': fields.List(fields.Nested(unread_chat_model)),
+})
+
 file_model = api.model('File model', {
     'file': fields.String
 })
@@ -1,3 +1,12 @@
 from .file_upload import *
+from .chat_events import *
+from .jobs import *
+from .counters import *
+from .projections import *
+from .auth_scope import *
+from .mailer import *
+from .payments import *
+from .pricing import *
 from .services import *
-
+from .maintenance import *
+from .tasks import *
@@ -0,0 +1,79 @@
+__all__ = ['AuthScope', 'AuthScopeCache', 'auth_scope_cache', 'get_auth_scope']
+
+import threading
+import time
+from collections import OrderedDict
+
+from ip_app import app, session
+from ip_app.models import CourseTeacherCorrespondence
+
+
+class AuthScope:
+    """
+    What a user is allowed to see: role flags and ids of the taught courses.
+    """
+    __slots__ = ('user_id', 'role', 'is_admin', 'is_teacher', 'course_ids')
+
+    def __init__(self, user_id, role, course_ids):
+        self.user_id = user_id
+        self.role = role
+        self.is_admin = role == 'ADMIN'
+        self.is_teacher = role == 'TEACHER'
+        self.course_ids = frozenset(course_ids)
+
+    def can_teach(self, course_id):
+        return self.is_admin or course_id in self.course_ids
+
+
+class AuthScopeCache:
+    """
+    Per-process cache of authorization scopes. Entries are invalidated explicitly when course teachers
+    or user roles change and expire after `ttl` seconds to pick up changes made by other processes.
+    Keeps the `max_size` most recently used scopes.
+    """
+
+    def __init__(self, ttl, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._scopes = OrderedDict()
+
+    def get(self, user):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._scopes.get(user.user_id)
+            if cached is not None:
+                self._scopes.move_to_end(user.user_id)
+        if cached is not None:
+            scope, expires = cached
+            if expires > now and scope.role == user.role:
+                return scope
+        scope = AuthScope(user.user_id, user.role, [course_id for course_id, in session.query(
+            CourseTeacherCorrespondence.course_id
+        ).filter(
+            CourseTeacherCorrespondence.teacher_id == user.user_id
+        ).all()])
+        with self._lock:
+            self._scopes[user.user_id] = scope, now + self.ttl
+            self._scopes.move_to_end(user.user_id)
+            while len(self._scopes) > self.max_size:
+                self._scopes.popitem(last=False)
+        return scope
+
+    def invalidate(self, user_ids=None):
+        """
+        :param user_ids: ids of users whose scopes are stale, all scopes if None
+        """
+        with self._lock:
+            if user_ids is None:
+                self._scopes.clear()
+            else:
+                for user_id in user_ids:
+                    self._scopes.pop(user_id, None)
+
+
+auth_scope_cache = AuthScopeCache(app.config['AUTH_SCOPE_TTL_SECONDS'], app.config['AUTH_SCOPE_CACHE_SIZE'])
+
+
+def get_auth_scope(user):
+    return auth_scope_cache.get(user)
@@ -0,0 +1,160 @@
+__all__ = ['ChatEventBus', 'LocalChatEventBackend', 'DatabaseChatEventBackend', 'create_chat_event_backend',
+           'chat_event_bus']
+
+import threading
+import time
+from collections import deque
+
+from ip_app import app, db, session, logger
+from ip_app.models import Chat, ChatThread, ChatLine
+
+
+class ChatEventBus:
+    """
+    In-process pub/sub for new chat lines.
+    Each event is a dict with event_id (chat_line_id), chat_id, chat_thread_id, course_id, student_id and sender.
+    Publishing goes through a backend, which is responsible for delivering events
+    (from this or other workers) back to the bus with `dispatch`.
+    """
+
+    def __init__(self, backend, buffer_size=1000):
+        self._condition = threading.Condition()
+        self._events = deque(maxlen=buffer_size)
+        self._started = False
+        self.last_event_id = 0
+        self.backend = backend
+
+    def set_backend(self, backend):
+        with self._condition:
+            if self._started:
+                self.backend.stop()
+            self.backend = backend
+            self._started = False
+
+    def start(self):
+        with self._condition:
+            if not self._started:
+                self.backend.start(self)
+                self._started = True
+
+    def publish(self, event):
+        self.backend.publish(self, event)
+
+    def dispatch(self, events):
+        with self._condition:
+            for event in events:
+                self._events.append(event)
+                self.last_event_id = max(self.last_event_id, event['event_id'])
+            self._condition.notify_all()
+
+    def wait(self, since, matches, timeout):
+        """
+        Blocks until there are events newer than `since` accepted by `matches` or until timeout.
+        :param int since: last event_id known to the client
+        :param matches: predicate applied to events
+        :param float timeout: seconds to wait
+        :return list: matching events in order of arrival
+        """
+        self.start()
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                events = [event for event in self._events if event['event_id'] > since and matches(event)]
+                remaining = deadline - time.monotonic()
+                if events or remaining <= 0:
+                    return events
+                self._condition.wait(remaining)
+
+
+class LocalChatEventBackend:
+    """
+    Delivers events only within the current process. Suitable for a single worker and for tests.
+    """
+
+    def start(self, bus):
+        pass
+
+    def stop(self):
+        pass
+
+    def publish(self, bus, event):
+        bus.dispatch([event])
+
+
+class DatabaseChatEventBackend:
+    """
+    Cross-worker backend: one background thread per worker polls hw_chat_lines for new ids
+    and dispatches them to the bus. Cost is one indexed query per interval per worker,
+    independent of the number of waiting clients.
+    """
+
+    def __init__(self, flask_app, interval=1.0):
+        self.app = flask_app
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self, bus):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, args=(bus,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def publish(self, bus, event):
+        # Committed lines are picked up by the pollers of all workers, including this one
+        pass
+
+    def _run(self, bus):
+        with self.app.app_context():
+            last_id = session.query(db.func.max(ChatLine.chat_line_id)).scalar() or 0
+            session.remove()
+            while not self._stopped.wait(self.interval):
+                try:
+                    rows = session.query(
+                        ChatLine.chat_line_id,
+                        ChatLine.chat_thread_id,
+                        ChatLine.sender,
+                        Chat.chat_id,
+                        Chat.course_id,
+                        Chat.student_id
+                    ).join(
+                        ChatThread,
+                        ChatThread.chat_thread_id == ChatLine.chat_thread_id
+                    ).join(
+                        Chat,
+                        Chat.chat_id == ChatThread.chat_id
+                    ).filter(
+                        ChatLine.chat_line_id > last_id
+                    ).order_by(
+                        ChatLine.chat_line_id
+                    ).all()
+                except Exception:
+                    logger.exception('Chat events polling failed')
+                    continue
+                finally:
+                    session.remove()
+                if rows:
+                    last_id = rows[-1].chat_line_id
+                    bus.dispatch([{
+                        'event_id': row.chat_line_id,
+                        'chat_id': row.chat_id,
+                        'chat_thread_id': row.chat_thread_id,
+                        'course_id': row.course_id,
+                        'student_id': row.student_id,
+                        'sender': row.sender,
+                    } for row in rows])
+
+
+def create_chat_event_backend(config):
+    backend = config['CHAT_EVENTS_BACKEND']
+    if backend == 'local':
+        return LocalChatEventBackend()
+    elif backend == 'database':
+        return DatabaseChatEventBackend(app, config['CHAT_EVENTS_DB_POLL_INTERVAL'])
+    else:
+        raise ValueError(backend)
+
+
+chat_event_bus = ChatEventBus(create_chat_event_backend(app.config))
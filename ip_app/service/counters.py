@@ -0,0 +1,77 @@
+__all__ = ['StatisticsCounters', 'statistics_counters']
+
+import threading
+from collections import defaultdict
+
+from ip_app import db, session, logger
+from ip_app.models import Statistics
+
+
+class StatisticsCounters:
+    """
+    Accumulates changes of statistics counters in memory and applies them to the statistics table in one transaction.
+    Counters missing in the table are created by the statistics reconciliation, their changes are kept until then.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._deltas = defaultdict(int)
+
+    def add(self, name, delta=1):
+        if delta:
+            with self._lock:
+                self._deltas[name] += delta
+
+    def add_all(self, deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                if delta:
+                    self._deltas[name] += delta
+
+    def pending(self):
+        with self._lock:
+            return dict(self._deltas)
+
+    def discard(self, names):
+        """
+        Drops pending changes of the counters, e.g. because they are being recounted.
+        """
+        with self._lock:
+            for name in names:
+                self._deltas.pop(name, None)
+
+    def flush(self):
+        """
+        :return dict: applied deltas
+        """
+        with self._lock:
+            deltas, self._deltas = dict(self._deltas), defaultdict(int)
+        deltas = {name: delta for name, delta in deltas.items() if delta}
+        if not deltas:
+            return deltas
+        try:
+            existing = {name for name, in session.query(
+                Statistics.statistics_name
+            ).filter(
+                Statistics.statistics_name.in_(list(deltas))
+            )}
+            missing = {name: delta for name, delta in deltas.items() if name not in existing}
+            if missing:
+                self.add_all(missing)
+                deltas = {name: delta for name, delta in deltas.items() if name in existing}
+            for name, delta in deltas.items():
+                Statistics.query.filter(
+                    Statistics.statistics_name == name
+                ).update({
+                    Statistics.value: db.func.greatest(db.cast(Statistics.value, db.Integer) + delta, 0)
+                }, synchronize_session=False)
+            session.commit()
+        except Exception:
+            session.rollback()
+            logger.exception('Failed to flush statistics counters')
+            self.add_all(deltas)
+            return {}
+        return deltas
+
+
+statistics_counters = StatisticsCounters()
@@ -1,17 +1,22 @@
 from wand.image import Image
 import hashlib
-import time
 import hmac
 import copy
 import os
+import tempfile
 
-from werkzeug.utils import secure_filename
+from werkzeug.utils import secure_filename, safe_join
 
 # File saver
 import ip_app
 
 
+class UploadValidationError(Exception):
+    pass
+
+
 class FileLoader:
+    chunkSize = 64 * 1024
     defaultUploadOptions = {
         "fieldname": "file",
         "validation": {
@@ -22,7 +27,10 @@ class FileLoader:
 
     @staticmethod
     def get_file(file_id):
-        return os.path.join(Utils.getServerPath(), file_id)
+        """
+        Path of the stored file or None if file_id points outside of the upload folder.
+        """
+        return safe_join(Utils.getServerPath(), file_id)
 
 
     @classmethod
@@ -41,32 +49,76 @@ class FileLoader:
         else:
             options = Utils.merge_dicts(cls.defaultUploadOptions, options)
 
-        # Get extension.
         filename = req.getFilename(options["fieldname"])
-        extension = Utils.getExtension(filename)
-        extension = "." + extension if extension else ""
-
-        # Generate new random name.
-        sha1 = hashlib.sha1(str(time.time()).encode("utf-8")).hexdigest()
-        routeFilename = secure_filename(os.path.join(fileRoute, sha1 + extension))
 
-        fullNamePath = cls.get_file(routeFilename)
-
-        req.saveFile(options["fieldname"], fullNamePath)
-        # Check validation.
+        # Check validation before anything is written.
         if "validation" in options:
-            if not Utils.isValid(options["validation"], fullNamePath, req.getMimetype(options["fieldname"])):
-                FileLoader.delete(routeFilename)
-                raise Exception("File does not meet the validation.")
+            header = req.peekFile(options["fieldname"], Utils.magicNumbersLength)
+            if not Utils.isValid(options["validation"], filename, req.getMimetype(options["fieldname"]), header):
+                raise UploadValidationError("File does not meet the validation.")
+
+        # Name the file by its content, identical uploads are stored once.
+        stream = req.getStream(options["fieldname"])
+        resize = options.get("resize")
+        contentHash = Utils.hashStream(stream, resize)
+        routeFilename = cls.getRouteFilename(fileRoute, contentHash, Utils.getExtension(secure_filename(filename)))
 
-        if "resize" in options and options["resize"] is not None:
-            with Image(filename=fullNamePath) as img:
-                img.transform(resize=options["resize"])
-                img.save(filename=fullNamePath)
+        fullNamePath = cls.get_file(routeFilename)
+        if not os.path.exists(fullNamePath):
+            cls.saveStream(stream, fullNamePath, resize)
 
         # build and send response.
         return {'file': routeFilename}
 
+    @staticmethod
+    def getRouteFilename(fileRoute, contentHash, extension):
+        """
+        Sharded path of a file: fileRoute/ab/cd/abcd....ext, to keep directories small.
+        Parameters:
+          fileRoute: string
+          contentHash: string, hex digest
+          extension: string without the dot
+        Return:
+          string
+        """
+        name = contentHash + ("." + extension.lower() if extension else "")
+        return "/".join((secure_filename(fileRoute), contentHash[:2], contentHash[2:4], name))
+
+    @classmethod
+    def saveStream(cls, stream, fullNamePath, resize=None):
+        """
+        Write stream to a temporary file in the target directory in chunks, then rename it,
+        so that partially written files are never visible under fullNamePath.
+        Parameters:
+          stream: file-like object
+          fullNamePath: string
+          resize: string optional, see ImageLoader.defaultUploadOptions
+        """
+        directory = os.path.dirname(fullNamePath)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmpPath = tempfile.mkstemp(dir=directory, prefix=".upload-")
+        try:
+            with os.fdopen(fd, "wb") as tmpFile:
+                while True:
+                    chunk = stream.read(cls.chunkSize)
+                    if not chunk:
+                        break
+                    tmpFile.write(chunk)
+
+            if resize is not None:
+                with Image(filename=tmpPath) as img:
+                    img.transform(resize=resize)
+                    img.save(filename=tmpPath)
+
+            os.chmod(tmpPath, 0o644)
+            os.replace(tmpPath, fullNamePath)
+        except BaseException:
+            try:
+                os.remove(tmpPath)
+            except OSError:
+                pass
+            raise
+
     @staticmethod
     def delete(src):
         """
@@ -75,7 +127,9 @@ class FileLoader:
           src: string
         """
 
-        filePath = Utils.getServerPath() + src
+        filePath = FileLoader.get_file(src)
+        if filePath is None:
+            return
         try:
             os.remove(filePath)
         except OSError:
@@ -114,6 +168,20 @@ class FlaskAdapter:
         self.checkFile(fieldname)
         return self.request.files[fieldname].content_type
 
+    def getStream(self, fieldname):
+        self.checkFile(fieldname)
+        return self.request.files[fieldname].stream
+
+    def peekFile(self, fieldname, size):
+        """
+        Read the first size bytes of the file without consuming them.
+        """
+        stream = self.getStream(fieldname)
+        position = stream.tell()
+        header = stream.read(size)
+        stream.seek(position)
+        return header
+
     def saveFile(self, fieldname, fullNamePath):
         self.checkFile(fieldname)
         file = self.request.files[fieldname]
@@ -121,6 +189,17 @@ class FlaskAdapter:
 
 
 class Utils(object):
+    # Leading bytes of files by extension. Extensions missing here are not checked.
+    magicNumbers = {
+        "gif": [b"GIF87a", b"GIF89a"],
+        "jpeg": [b"\xff\xd8\xff"],
+        "jpg": [b"\xff\xd8\xff"],
+        "png": [b"\x89PNG\r\n\x1a\n"],
+        "pdf": [b"%PDF-"],
+        "doc": [b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"],
+    }
+    magicNumbersLength = 64
+
     @staticmethod
     def hmac(key, string, nobinary=False):
         """
@@ -181,14 +260,15 @@ class Utils(object):
         return os.path.splitext(filename)[1][1:]
 
     @staticmethod
-    def isFileValid(filename, mimetype, allowedExts, allowedMimeTypes):
+    def isFileValid(filename, mimetype, allowedExts, allowedMimeTypes, header=None):
         """
-        Test if a file is valid based on its extension and mime type.
+        Test if a file is valid based on its extension, mime type and leading bytes.
         Parameters:
             filename string
             mimeType string
             allowedExts list
             allowedMimeTypes list
+            header bytes optional, beginning of the file
         Return:
             boolean
         """
@@ -197,8 +277,50 @@ class Utils(object):
         if not allowedExts or not allowedMimeTypes:
             return False
 
-        extension = Utils.getExtension(filename)
-        return extension.lower() in allowedExts and mimetype in allowedMimeTypes
+        extension = Utils.getExtension(filename).lower()
+        if extension not in allowedExts or mimetype not in allowedMimeTypes:
+            return False
+        return header is None or Utils.hasValidMagicNumber(extension, header)
+
+    @staticmethod
+    def hasValidMagicNumber(extension, header):
+        """
+        Test if the file content matches its extension.
+        Parameters:
+            extension string, lowercase without the dot
+            header bytes, beginning of the file
+        Return:
+            boolean
+        """
+        if extension == "svg":
+            text = header.lstrip(b"\xef\xbb\xbf").lstrip()
+            return text.startswith(b"<")
+        signatures = Utils.magicNumbers.get(extension)
+        if signatures is None:
+            return True
+        return any(header.startswith(signature) for signature in signatures)
+
+    @staticmethod
+    def hashStream(stream, resize=None):
+        """
+        Hash the stream content and rewind it.
+        Parameters:
+         stream: seekable file-like object
+         resize: string optional, included in the hash as it changes the stored file
+        Return:
+         string: sha256 hex digest
+        """
+        sha256 = hashlib.sha256()
+        position = stream.tell()
+        while True:
+            chunk = stream.read(FileLoader.chunkSize)
+            if not chunk:
+                break
+            sha256.update(chunk)
+        stream.seek(position)
+        if resize is not None:
+            sha256.update(b"\0resize:" + resize.encode("utf-8"))
+        return sha256.hexdigest()
 
     @staticmethod
     def getServerPath():
@@ -210,13 +332,14 @@ class Utils(object):
         return ip_app.app.config['UPLOAD_FOLDER']
 
     @staticmethod
-    def isValid(validation, filePath, mimetype):
+    def isValid(validation, filename, mimetype, header=None):
         """
         Generic file validation.
         Parameters:
          validation: dict or function
-         filePath: string
+         filename: string
          mimetype: string
+         header: bytes optional, beginning of the file
         """
 
         # No validation means you dont want to validate, so return affirmative.
@@ -225,10 +348,11 @@ class Utils(object):
 
         # Validation is a function provided by the user.
         if callable(validation):
-            return validation(filePath, mimetype)
+            return validation(filename, mimetype)
 
         if isinstance(validation, dict):
-            return Utils.isFileValid(filePath, mimetype, validation["allowedExts"], validation["allowedMimeTypes"])
+            return Utils.isFileValid(filename, mimetype, validation["allowedExts"], validation["allowedMimeTypes"],
+                                     header)
 
         # Else: no specific validating behaviour found.
         return False
@@ -0,0 +1,235 @@
+__all__ = ['job_handler', 'enqueue_job', 'run_next_job', 'start_job_workers', 'run_job_workers']
+
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, and_
+from sqlalchemy.dialects.mysql import insert
+
+from ip_app import app, db, session, logger
+from ip_app.models import Job, JobTypeLock
+
+job_handlers = {}
+
+
+class JobHandler:
+    def __init__(self, func, job_type, max_attempts, concurrency):
+        self.func = func
+        self.job_type = job_type
+        self.max_attempts = max_attempts
+        self.concurrency = concurrency
+
+
+def job_handler(job_type=None, max_attempts=5, concurrency=None):
+    """
+    Registers a function as a handler of background jobs of the given type.
+    The function is called with the job payload as keyword arguments inside the app context.
+    :param job_type: defaults to the function name
+    :param max_attempts: the job is marked FAILED after this number of failed attempts
+    :param concurrency: max number of simultaneously running jobs of this type,
+                        defaults to JOB_CONCURRENCY[job_type] or 1
+    """
+    def decorator(func):
+        name = job_type or func.__name__
+        limit = concurrency or app.config['JOB_CONCURRENCY'].get(name, 1)
+        job_handlers[name] = JobHandler(func, name, max_attempts, limit)
+        return func
+
+    return decorator
+
+
+def enqueue_job(job_type, payload=None, delay=0, commit=True):
+    """
+    Puts a job into the queue. With commit=False the job is saved together with the caller's transaction.
+    """
+    job = Job(
+        job_type=job_type,
+        payload=payload or {},
+        status='PENDING',
+        attempts=0,
+        run_at=datetime.now() + timedelta(seconds=delay)
+    )
+    session.add(job)
+    if commit:
+        session.commit()
+    return job
+
+
+def get_running_job_counts(now, job_type=None):
+    query = session.query(
+        Job.job_type,
+        db.func.count(Job.job_id)
+    ).filter(
+        Job.status == 'RUNNING',
+        Job.locked_until > now
+    )
+    if job_type is not None:
+        query = query.filter(Job.job_type == job_type)
+    return dict(query.group_by(Job.job_type).all())
+
+
+def get_claimable_job_filters(now, expired=None):
+    """
+    :param expired: only PENDING jobs if False, only RUNNING jobs with expired lease if True, both if None
+    """
+    pending = Job.status == 'PENDING'
+    lease_expired = and_(Job.status == 'RUNNING', Job.locked_until <= now)
+    if expired is None:
+        return or_(pending, lease_expired),
+    return lease_expired if expired else pending,
+
+
+def lock_job_type(job_type):
+    """
+    Locks the row of the job type until the end of the transaction, creating it if needed.
+    """
+    stmt = insert(JobTypeLock).values(job_type=job_type)
+    session.execute(stmt.on_duplicate_key_update(job_type=stmt.inserted.job_type))
+
+
+def claim_job():
+    """
+    Takes the next due job, respecting concurrency limits of job types.
+    Jobs of crashed workers are taken again after their lease expires, which counts as a failed attempt.
+    :return: claimed job or None
+    """
+    now = datetime.now()
+    running = get_running_job_counts(now)
+    job_types = [job_type for job_type, handler in job_handlers.items()
+                 if running.get(job_type, 0) < handler.concurrency]
+    if not job_types:
+        session.commit()
+        return None
+    candidates = session.query(
+        Job.job_id,
+        Job.job_type,
+        Job.status
+    ).filter(
+        Job.job_type.in_(job_types),
+        Job.run_at <= now,
+        *get_claimable_job_filters(now)
+    ).order_by(
+        Job.run_at,
+        Job.job_id
+    ).limit(app.config['JOB_WORKERS']).all()
+    session.commit()
+    for candidate in candidates:
+        job = claim_candidate_job(candidate, now)
+        if job is not None:
+            return job
+    return None
+
+
+def claim_candidate_job(candidate, now):
+    handler = job_handlers[candidate.job_type]
+    # Claims of one job type are serialized, so the running count can't change before commit
+    lock_job_type(candidate.job_type)
+    if get_running_job_counts(now, candidate.job_type).get(candidate.job_type, 0) >= handler.concurrency:
+        session.commit()
+        return None
+    expired = candidate.status == 'RUNNING'
+    values = {
+        Job.status: 'RUNNING',
+        Job.locked_until: now + timedelta(seconds=app.config['JOB_LEASE_SECONDS']),
+    }
+    if expired:
+        values[Job.attempts] = Job.attempts + 1
+    claimed = Job.query.filter(
+        Job.job_id == candidate.job_id,
+        *get_claimable_job_filters(now, expired)
+    ).update(values, synchronize_session=False)
+    session.commit()
+    if not claimed:
+        return None
+    job = Job.query.get(candidate.job_id)
+    if expired and job.attempts >= handler.max_attempts:
+        job.status = 'FAILED'
+        job.locked_until = None
+        job.last_error = 'Lease expired'
+        session.commit()
+        logger.error('Job {} ({}) failed: lease expired {} times'.format(job.job_id, job.job_type, job.attempts))
+        return None
+    return job
+
+
+def run_job(job):
+    handler = job_handlers[job.job_type]
+    try:
+        handler.func(**(job.payload or {}))
+    except Exception as e:
+        session.rollback()
+        job.attempts += 1
+        job.last_error = repr(e)[:300]
+        if job.attempts >= handler.max_attempts:
+            job.status = 'FAILED'
+            logger.exception('Job {} ({}) failed'.format(job.job_id, job.job_type))
+        else:
+            job.status = 'PENDING'
+            job.run_at = datetime.now() + timedelta(
+                seconds=app.config['JOB_RETRY_BASE_DELAY'] * 2 ** (job.attempts - 1))
+            logger.warning('Job {} ({}) will be retried: {}'.format(job.job_id, job.job_type, job.last_error))
+    else:
+        job.attempts += 1
+        job.status = 'DONE'
+    job.locked_until = None
+    session.commit()
+
+
+def run_next_job():
+    """
+    Runs one due job, if any.
+    :return bool: whether a job was run
+    """
+    job = claim_job()
+    if job is None:
+        return False
+    run_job(job)
+    return True
+
+
+def job_worker_loop(stop_event):
+    with app.app_context():
+        while not stop_event.is_set():
+            try:
+                has_job = run_next_job()
+            except Exception:
+                logger.exception('Job worker error')
+                session.rollback()
+                has_job = False
+            finally:
+                session.remove()
+            if not has_job:
+                stop_event.wait(app.config['JOB_POLL_INTERVAL'])
+
+
+def start_job_workers(workers=None, stop_event=None):
+    """
+    Starts a pool of job worker threads in the current process.
+    :param workers: number of worker threads, defaults to JOB_WORKERS
+    :return list: started threads
+    """
+    if stop_event is None:
+        stop_event = threading.Event()
+    threads = [threading.Thread(target=job_worker_loop, args=(stop_event,), daemon=True)
+               for _ in range(workers or app.config['JOB_WORKERS'])]
+    for thread in threads:
+        thread.start()
+    logger.info('Started {} job workers for {}'.format(len(threads), ', '.join(sorted(job_handlers))))
+    return threads
+
+
+def run_job_workers(workers=None, stop_event=None):
+    """
+    Runs a pool of job workers until stop_event is set or the process is interrupted.
+    """
+    if stop_event is None:
+        stop_event = threading.Event()
+    threads = start_job_workers(workers, stop_event)
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop_event.set()
+    for thread in threads:
+        thread.join()
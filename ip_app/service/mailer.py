@@ -0,0 +1,187 @@
+__all__ = ['email_templates', 'SMTPEmailBackend', 'FileEmailBackend', 'LocalEmailBackend', 'EmailRateLimiter',
+           'create_email_backend', 'build_email', 'send_email', 'deliver_email', 'email_backend']
+
+import os
+import smtplib
+import threading
+import time
+from email.message import EmailMessage
+from uuid import uuid4
+
+from ip_app import app
+from .jobs import job_handler, enqueue_job
+
+email_templates = {
+    'registration_hash': (
+        'Регистрация на i-Proffi',
+        'Здравствуйте{name}!\n\n'
+        'Для завершения регистрации перейдите по ссылке:\n{link}\n'
+    ),
+    'course_application': (
+        'Заявка на курс «{course_title}»',
+        'Здравствуйте{name}!\n\n'
+        'Мы получили вашу заявку на курс «{course_title}» и скоро свяжемся с вами.\n'
+    ),
+}
+
+
+class SMTPEmailBackend:
+    """
+    Sends messages through one SMTP connection, which is kept open between messages.
+    """
+
+    stale_connection_errors = (smtplib.SMTPServerDisconnected, BrokenPipeError, ConnectionResetError)
+
+    def __init__(self, host, port, username=None, password=None, use_tls=True, timeout=10):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self.connection = None
+
+    def open(self):
+        if self.connection is not None:
+            return
+        connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.use_tls:
+            connection.starttls()
+        if self.username:
+            connection.login(self.username, self.password)
+        self.connection = connection
+
+    def send(self, message):
+        self.open()
+        try:
+            self.connection.send_message(message)
+        except self.stale_connection_errors:
+            # The server closed the idle connection, retry on a new one
+            self.connection = None
+            self.open()
+            self.connection.send_message(message)
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.connection = None
+
+
+class FileEmailBackend:
+    """
+    Stand-in backend: writes each message to a separate .eml file.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+    def send(self, message):
+        file_name = '{}-{}.eml'.format(time.strftime('%Y%m%d-%H%M%S'), uuid4().hex)
+        with open(os.path.join(self.directory, file_name), 'wb') as f:
+            f.write(message.as_bytes())
+
+    def close(self):
+        pass
+
+
+class LocalEmailBackend:
+    """
+    Stand-in backend: keeps sent messages in memory (see `outbox`).
+    """
+
+    def __init__(self):
+        self.outbox = []
+
+    def open(self):
+        pass
+
+    def send(self, message):
+        self.outbox.append(message)
+
+    def close(self):
+        pass
+
+
+class EmailRateLimiter:
+    """
+    Spaces out messages sent by this process, no more than `rate_limit` messages per second.
+    """
+
+    def __init__(self, rate_limit=10):
+        self.min_interval = 1.0 / rate_limit if rate_limit else 0
+        self._lock = threading.Lock()
+        self._last_sent = 0
+
+    def wait(self):
+        with self._lock:
+            wait = self._last_sent + self.min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self._last_sent = time.monotonic()
+
+
+def create_email_backend(config):
+    backend = config['EMAIL_BACKEND']
+    if backend == 'smtp':
+        return SMTPEmailBackend(config['SMTP_HOST'], config['SMTP_PORT'],
+                                username=config['SMTP_USERNAME'],
+                                password=config['SMTP_PASSWORD'],
+                                use_tls=config['SMTP_USE_TLS'],
+                                timeout=config['SMTP_TIMEOUT'])
+    elif backend == 'file':
+        return FileEmailBackend(config['EMAIL_FILE_DIR'])
+    elif backend == 'local':
+        return LocalEmailBackend()
+    else:
+        raise ValueError(backend)
+
+
+def build_email(template, to, **context):
+    subject, body = email_templates[template]
+    message = EmailMessage()
+    message['From'] = app.config['EMAIL_SENDER']
+    message['To'] = to
+    message['Subject'] = subject.format(**context)
+    message.set_content(body.format(**context))
+    return message
+
+
+def send_email(template, to, **context):
+    """
+    Queues an email built from the template as a background job.
+    The job is saved together with the caller's transaction, so the caller must commit.
+    """
+    enqueue_job('send_email', {
+        'template': template,
+        'to': to,
+        'context': context,
+    }, commit=False)
+
+
+email_backend = create_email_backend(app.config)
+email_backend_lock = threading.Lock()
+email_rate_limiter = EmailRateLimiter(app.config['EMAIL_RATE_LIMIT'])
+
+
+@job_handler(job_type='send_email', max_attempts=app.config['EMAIL_MAX_ATTEMPTS'])
+def deliver_email(template, to, context):
+    """
+    Sends an email queued by `send_email`. Runs as a background job, failed attempts are retried by the job queue.
+    The backend is shared by the workers of the process, so the SMTP connection is reused between messages.
+    """
+    message = build_email(template, to, **context)
+    with email_backend_lock:
+        email_rate_limiter.wait()
+        email_backend.open()
+        try:
+            email_backend.send(message)
+        except Exception:
+            # Don't reuse a connection in an unknown state
+            email_backend.close()
+            raise
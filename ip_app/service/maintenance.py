@@ -0,0 +1,122 @@
+__all__ = ['archive_inactive_users', 'delete_expired_registrations', 'delete_stale_orders', 'collect_garbage']
+
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_
+
+from ip_app import app, db, session, logger
+from ip_app.models import User, Access, UserRegistration, Order
+from .counters import statistics_counters
+
+
+def get_archivable_users_filters():
+    """
+    Active students without current or future access.
+    """
+    current_or_future_access = session.query(
+        Access.access_id
+    ).filter(
+        Access.user_id == User.user_id,
+        or_(Access.end_date >= db.func.now(),
+            Access.end_date.is_(None))
+    )
+    return (User.role == 'STUDENT',
+            User.status == 'ACTIVE',
+            ~current_or_future_access.exists())
+
+
+def archive_inactive_users(batch_size=None):
+    """
+    Moves students whose access has ended to ARCHIVED, in batches of `batch_size` users ordered by user_id.
+    The change of the studying counter is flushed before returning.
+    :return list: (rows changed, seconds) for each batch
+    """
+    batch_size = batch_size or app.config['MAINTENANCE_BATCH_SIZE']
+    report = []
+    last_user_id = 0
+    while True:
+        started = time.perf_counter()
+        user_ids = [user_id for user_id, in session.query(
+            User.user_id
+        ).filter(
+            User.user_id > last_user_id,
+            *get_archivable_users_filters()
+        ).order_by(
+            User.user_id
+        ).limit(batch_size).all()]
+        if not user_ids:
+            session.commit()
+            break
+        changed = User.query.filter(
+            User.user_id.in_(user_ids),
+            *get_archivable_users_filters()
+        ).update({User.status: 'ARCHIVED'}, synchronize_session=False)
+        session.commit()
+        statistics_counters.add('studying', -changed)
+        last_user_id = user_ids[-1]
+        report.append((changed, time.perf_counter() - started))
+        logger.info('Archived {} users in {:.3f}s'.format(changed, report[-1][1]))
+    # Also run from update_user_statuses.py, where no scheduler flushes the counters
+    statistics_counters.flush()
+    return report
+
+
+def delete_in_chunks(model, primary_key, filters, batch_size):
+    """
+    Deletes rows matching filters in chunks of batch_size, committing after each chunk to keep locks short.
+    :return int: number of deleted rows
+    """
+    deleted = 0
+    while True:
+        ids = [row_id for row_id, in session.query(
+            primary_key
+        ).filter(
+            *filters
+        ).order_by(
+            primary_key
+        ).limit(batch_size).all()]
+        if not ids:
+            session.commit()
+            return deleted
+        deleted += model.query.filter(
+            primary_key.in_(ids),
+            *filters
+        ).delete(synchronize_session=False)
+        session.commit()
+
+
+def delete_expired_registrations(batch_size=None):
+    """
+    Deletes registration requests older than REGISTRATION_TTL_DAYS.
+    """
+    return delete_in_chunks(
+        UserRegistration,
+        UserRegistration.email,
+        (UserRegistration.date < datetime.now() - timedelta(days=app.config['REGISTRATION_TTL_DAYS']),),
+        batch_size or app.config['MAINTENANCE_BATCH_SIZE'])
+
+
+def delete_stale_orders(batch_size=None):
+    """
+    Deletes unpaid (CREATED or FAILED) orders older than STALE_ORDER_TTL_DAYS together with their items.
+    """
+    return delete_in_chunks(
+        Order,
+        Order.order_id,
+        (Order.status.in_(('CREATED', 'FAILED')),
+         Order.order_date < datetime.now() - timedelta(days=app.config['STALE_ORDER_TTL_DAYS'])),
+        batch_size or app.config['MAINTENANCE_BATCH_SIZE'])
+
+
+def collect_garbage(batch_size=None):
+    """
+    :return dict: numbers of removed rows by table
+    """
+    removed = {
+        'users_registration': delete_expired_registrations(batch_size),
+        'orders': delete_stale_orders(batch_size),
+    }
+    logger.info('Garbage collection removed {}'.format(
+        ', '.join('{} {}'.format(count, table) for table, count in removed.items())))
+    return removed
@@ -0,0 +1,274 @@
+__all__ = ['PaymentGatewayError', 'CircuitOpenError', 'GatewayBusyError', 'CircuitBreaker', 'GatewayMetrics',
+           'HTTPPaymentGatewayBackend', 'LocalPaymentGatewayBackend', 'PaymentGateway',
+           'create_payment_gateway_backend', 'payment_gateway', 'ProcessedCallbacks', 'processed_payment_callbacks']
+
+import http.client
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from ip_app import app, logger
+
+
+class PaymentGatewayError(Exception):
+    pass
+
+
+class CircuitOpenError(PaymentGatewayError):
+    pass
+
+
+class GatewayBusyError(PaymentGatewayError):
+    """
+    All connections are in use. Does not count as a gateway failure.
+    """
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and rejects calls for `reset_timeout` seconds.
+    Then lets a single trial call through: success closes the circuit, failure opens it again.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'CLOSED', 'OPEN', 'HALF_OPEN'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at < self.reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self):
+        with self._lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+    def record_skipped(self):
+        """
+        The allowed call was not made, e.g. it was rejected locally.
+        """
+        with self._lock:
+            self._trial_running = False
+
+
+class GatewayMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.rejected = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, elapsed, failed):
+        with self._lock:
+            self.requests += 1
+            self.failures += failed
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+    def record_rejected(self):
+        with self._lock:
+            self.rejected += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'failures': self.failures,
+                'rejected': self.rejected,
+                'average_ms': self.total_time / self.requests * 1000 if self.requests else 0,
+                'max_ms': self.max_time * 1000,
+            }
+
+
+class HTTPPaymentGatewayBackend:
+    """
+    Creates payments with `POST <url>/payments`, JSON body {order_id, amount, callback_url},
+    expects JSON {payment_link}. Keeps up to `pool_size` persistent connections;
+    a request waits at most `pool_timeout` seconds for a free one, so a slow provider
+    ties up at most `pool_size` request threads.
+    """
+
+    stale_connection_errors = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+
+    def __init__(self, url, api_key=None, pool_size=4, timeout=5, pool_timeout=0.5):
+        parts = urlsplit(url)
+        self.connection_cls = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path.rstrip('/')
+        self.api_key = api_key
+        self.timeout = timeout
+        self.pool_timeout = pool_timeout
+        self._pool = queue.LifoQueue()
+        for _ in range(pool_size):
+            self._pool.put(None)
+
+    def create_payment(self, order_id, amount, callback_url):
+        try:
+            connection = self._pool.get(timeout=self.pool_timeout)
+        except queue.Empty:
+            raise GatewayBusyError('No free connections to the payment gateway')
+        data = {
+            'order_id': order_id,
+            'amount': amount,
+            'callback_url': callback_url,
+        }
+        try:
+            if connection is not None:
+                try:
+                    status, body = self._request(connection, data)
+                except self.stale_connection_errors:
+                    # The provider closed the idle connection before reading the request, retry on a new one
+                    connection.close()
+                    connection = None
+            if connection is None:
+                connection = self.connection_cls(self.host, self.port, timeout=self.timeout)
+                status, body = self._request(connection, data)
+        except (OSError, http.client.HTTPException) as e:
+            if connection is not None:
+                connection.close()
+            connection = None
+            raise PaymentGatewayError('Payment gateway request failed: {}'.format(e))
+        finally:
+            self._pool.put(connection)
+        if status != 200:
+            raise PaymentGatewayError('Payment gateway responded with {}'.format(status))
+        try:
+            return json.loads(body)['payment_link']
+        except (ValueError, KeyError, TypeError):
+            raise PaymentGatewayError('Invalid payment gateway response')
+
+    def _request(self, connection, data):
+        headers = {'Content-Type': 'application/json'}
+        if self.api_key:
+            headers['Authorization'] = 'Bearer {}'.format(self.api_key)
+        connection.request('POST', self.path + '/payments', body=json.dumps(data), headers=headers)
+        response = connection.getresponse()
+        # The response must be read completely before the connection is reused
+        return response.status, response.read()
+
+
+class LocalPaymentGatewayBackend:
+    """
+    Stand-in backend without acquiring: the payment link leads straight to the payment callback.
+    """
+
+    def create_payment(self, order_id, amount, callback_url):
+        return callback_url
+
+
+class PaymentGateway:
+    def __init__(self, backend, circuit_breaker):
+        self.backend = backend
+        self.circuit_breaker = circuit_breaker
+        self.metrics = GatewayMetrics()
+
+    def create_payment_link(self, order_id, amount, callback_url):
+        """
+        :raise PaymentGatewayError: if the gateway failed or the circuit is open
+        """
+        if not self.circuit_breaker.allow():
+            self.metrics.record_rejected()
+            raise CircuitOpenError('Payment gateway is unavailable')
+        start = time.perf_counter()
+        try:
+            link = self.backend.create_payment(order_id, amount, callback_url)
+        except GatewayBusyError:
+            self.metrics.record_rejected()
+            self.circuit_breaker.record_skipped()
+            logger.warning('Payment gateway is busy, order {}'.format(order_id))
+            raise
+        except Exception as e:
+            self.metrics.record(time.perf_counter() - start, True)
+            self.circuit_breaker.record_failure()
+            logger.warning('Failed to create payment for order {}: {}'.format(order_id, e))
+            raise
+        self.metrics.record(time.perf_counter() - start, False)
+        self.circuit_breaker.record_success()
+        return link
+
+    def get_metrics(self):
+        metrics = self.metrics.snapshot()
+        metrics['circuit'] = self.circuit_breaker.state
+        return metrics
+
+
+def create_payment_gateway_backend(config):
+    backend = config['PAYMENT_GATEWAY_BACKEND']
+    if backend == 'http':
+        return HTTPPaymentGatewayBackend(config['PAYMENT_GATEWAY_URL'],
+                                         api_key=config['PAYMENT_GATEWAY_API_KEY'],
+                                         pool_size=config['PAYMENT_GATEWAY_POOL_SIZE'],
+                                         timeout=config['PAYMENT_GATEWAY_TIMEOUT'],
+                                         pool_timeout=config['PAYMENT_GATEWAY_POOL_TIMEOUT'])
+    elif backend == 'local':
+        return LocalPaymentGatewayBackend()
+    else:
+        raise ValueError(backend)
+
+
+payment_gateway = PaymentGateway(create_payment_gateway_backend(app.config),
+                                 CircuitBreaker(app.config['PAYMENT_GATEWAY_FAILURE_THRESHOLD'],
+                                                app.config['PAYMENT_GATEWAY_RESET_SECONDS']))
+
+
+class ProcessedCallbacks:
+    """
+    Results of completed payment callbacks by order_id, so that retried callbacks
+    are answered without touching the database. Keeps the `max_size` most recent results.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+
+    def get(self, order_id):
+        with self._lock:
+            return self._results.get(order_id)
+
+    def add(self, order_id, result):
+        with self._lock:
+            self._results[order_id] = result
+            self._results.move_to_end(order_id)
+            while len(self._results) > self.max_size:
+                self._results.popitem(last=False)
+
+
+processed_payment_callbacks = ProcessedCallbacks(app.config['PAYMENT_CALLBACK_CACHE_SIZE'])
@@ -0,0 +1,116 @@
+__all__ = ['CourseProductPrice', 'ServiceProductPrice', 'PromoRule', 'apply_discount', 'is_promo_active', 'price_cart',
+           'PricingCatalog', 'pricing_catalog']
+
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from ip_app import app, session
+from ip_app.models import CourseProduct, ServiceProduct, PromoCode
+from .projections import projection
+
+price_fields = ('course_id', 'price', 'discount', 'discount_type')
+promo_fields = ('promocode', 'course_id', 'discount', 'discount_type', 'end_date')
+
+CourseProductPrice = projection('CourseProductPrice', 'course_product_id', *price_fields)
+ServiceProductPrice = projection('ServiceProductPrice', 'service_product_id', *price_fields)
+PromoRule = projection('PromoRule', *promo_fields)
+
+PricingSnapshot = namedtuple('PricingSnapshot', ('course_products', 'service_products', 'promocodes'))
+
+
+def apply_discount(price, discount, discount_type):
+    """
+    :param discount_type: 'P' - percent of the price, 'R' - amount in rubles
+    """
+    price = price or 0
+    if not discount:
+        return price
+    if discount_type == 'R':
+        return max(price - discount, 0)
+    return round(price * (100 - min(discount, 100)) / 100)
+
+
+def is_promo_active(promo):
+    return promo.end_date is None or promo.end_date > datetime.now()
+
+
+def price_cart(course_products, service_products, promo=None):
+    """
+    Applies product discounts to each product, then the promo code to the products it covers.
+    Products and promo may be ORM entities or catalog rows.
+    :return dict: prices of items and cart totals, see cart_quote_model
+    """
+    items = []
+    quote = {'course_products': [], 'service_products': []}
+    for list_name, key, products in (('course_products', 'course_product_id', course_products),
+                                     ('service_products', 'service_product_id', service_products)):
+        for pr in products:
+            item = {
+                key: getattr(pr, key),
+                'price': pr.price or 0,
+                'discounted_price': apply_discount(pr.price, pr.discount, pr.discount_type),
+            }
+            quote[list_name].append(item)
+            items.append((pr.course_id, item))
+    subtotal = sum(item['discounted_price'] for _, item in items)
+    promo_discount = 0
+    if promo is not None:
+        covered = sum(item['discounted_price'] for course_id, item in items
+                      if promo.course_id is None or promo.course_id == course_id)
+        promo_discount = covered - apply_discount(covered, promo.discount, promo.discount_type)
+    quote['price'] = sum(item['price'] for _, item in items)
+    quote['total'] = subtotal - promo_discount
+    quote['discount'] = quote['price'] - quote['total']
+    quote['promocode'] = promo.promocode if promo is not None else None
+    return quote
+
+
+class PricingCatalog:
+    """
+    Per-process snapshot of product prices and promo codes for cart quotes.
+    Reloaded on first use after `invalidate` (product edits) or when older than `ttl` seconds,
+    to pick up changes made by other processes.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._loaded_at = 0
+
+    def get_snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return snapshot
+        with self._lock:
+            # Another thread may have reloaded it while we were waiting
+            if self._snapshot is snapshot:
+                self._snapshot = self._load()
+                self._loaded_at = time.monotonic()
+            return self._snapshot
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+
+    @staticmethod
+    def _load():
+        return PricingSnapshot(
+            course_products={row.course_product_id: CourseProductPrice(**row._asdict()) for row in session.query(
+                CourseProduct.course_product_id,
+                *(getattr(CourseProduct, field) for field in price_fields)
+            ).all()},
+            service_products={row.service_product_id: ServiceProductPrice(**row._asdict()) for row in session.query(
+                ServiceProduct.service_product_id,
+                *(getattr(ServiceProduct, field) for field in price_fields)
+            ).all()},
+            # Lookups are case-insensitive, as in the database
+            promocodes={row.promocode.upper(): PromoRule(**row._asdict()) for row in session.query(
+                *(getattr(PromoCode, field) for field in promo_fields)
+            ).all()},
+        )
+
+
+pricing_catalog = PricingCatalog(app.config['PRICING_CATALOG_TTL_SECONDS'])
@@ -0,0 +1,41 @@
+__all__ = ['ProjectionRow', 'projection', 'UserRow', 'CourseRow', 'user_columns', 'course_columns', 'to_rows']
+
+from ip_app.models import User, Course
+
+
+class ProjectionRow:
+    """
+    Read-only row for list endpoints. Unlike ORM entities it is not tracked by the session
+    and stores only the selected columns in __slots__.
+    """
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for field in self.__slots__:
+            setattr(self, field, values.get(field))
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__,
+                               ', '.join('{}={!r}'.format(field, getattr(self, field)) for field in self.__slots__))
+
+
+def projection(name, *fields):
+    return type(name, (ProjectionRow,), {'__slots__': fields})
+
+
+user_fields = ('user_id', 'name', 'last_name', 'profile_pic_url', 'email', 'phone', 'city', 'role', 'status',
+               'registration_date', 'last_seen', 'birth_date', 'sex')
+course_fields = ('course_id', 'title', 'description', 'course_pic_url', 'author_name')
+
+UserRow = projection('UserRow', *user_fields, 'course', 'courses', 'courses_count')
+CourseRow = projection('CourseRow', *course_fields, 'progress_percent')
+
+user_columns = tuple(getattr(User, field) for field in user_fields)
+course_columns = tuple(getattr(Course, field) for field in course_fields)
+
+
+def to_rows(row_cls, query_rows):
+    """
+    Converts rows of a column query (see user_columns, course_columns) to projection rows.
+    """
+    return [row_cls(**row._asdict()) for row in query_rows]
@@ -1,11 +1,25 @@
 from datetime import datetime, timedelta
+from itertools import groupby
+from operator import attrgetter
 from uuid import uuid4
 
-from sqlalchemy import or_, and_
-from ip_app import session, db, Statistics, Notifications
+from sqlalchemy import or_, and_, case
+from sqlalchemy.dialects.mysql import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
+from ip_app import app, session, db, logger, Statistics, Notifications, MetricRollup
+from ip_app.constants import statistics_names
 from ip_app.models import User, CourseApplication, Course, Access, Video, CourseProduct, ServiceProduct, \
     UserRegistration, OrderCourseProductItem, OrderServiceProductItem, Order, VideoProgressTracking, \
-    CourseProgressTracking, ChatThread, ChatLine, Chat, hw_statuses, HomeWork
+    CourseProgressTracking, ChatThread, ChatLine, Chat, hw_statuses, HomeWork, PromoCode
+from .chat_events import chat_event_bus
+from .jobs import job_handler, enqueue_job
+from .counters import statistics_counters
+from .projections import UserRow, CourseRow, user_columns, course_columns
+from .auth_scope import auth_scope_cache, get_auth_scope
+from .mailer import send_email
+from .payments import payment_gateway, processed_payment_callbacks
+from .pricing import price_cart, is_promo_active, pricing_catalog
 
 
 def get_user(value, by='id'):
@@ -59,28 +73,52 @@ def register_user(data):
 
     session.delete(user_reg)
     session.commit()
+    track_user_statistics(None, (user.role, user.status))
     return True, user
 
 
 def patch_user(user_id, data):
     user = get_user(user_id)
+    old_role_and_status = user.role, user.status
     for attr, value in data.items():
         setattr(user, attr, value)
     session.commit()
+    track_user_statistics(old_role_and_status, (user.role, user.status))
     return user
 
 
 def delete_user(user_id):
     user = get_user(user_id)
+    old_role_and_status = user.role, user.status
     session.delete(user)
     session.commit()
+    auth_scope_cache.invalidate([user_id])
+    track_user_statistics(old_role_and_status, None)
+
+
+def get_user_statistics(role_and_status):
+    if role_and_status is None:
+        return {}
+    role, status = role_and_status
+    return {
+        'registered_students': int(role == 'STUDENT'),
+        'studying': int(role == 'STUDENT' and status == 'ACTIVE'),
+        'teachers': int(role == 'TEACHER'),
+    }
+
+
+def track_user_statistics(old_role_and_status, new_role_and_status):
+    old_values = get_user_statistics(old_role_and_status)
+    new_values = get_user_statistics(new_role_and_status)
+    statistics_counters.add_all({name: new_values.get(name, 0) - old_values.get(name, 0)
+                                 for name in set(old_values) | set(new_values)})
 
 
 def get_course_applications_filters(current_user):
     if current_user.role == 'ADMIN':
         return ()
     else:
-        return (CourseApplication.course_id.in_([x.course_id for x in current_user.taught_courses]), )
+        return (CourseApplication.course_id.in_(list(get_auth_scope(current_user).course_ids)), )
 
 
 def generate_token():
@@ -108,35 +146,54 @@ def check_last_seen(user):
 
 
 def get_multiple_users_query_for_current_user(user):
+    """
+    Users with active access (to the courses of the teacher), one row per user.
+    """
+    active_access = session.query(
+        Access.access_id
+    ).filter(
+        Access.user_id == User.user_id,
+        *get_current_active_filters()
+    )
     if user.role == 'ADMIN':
-        filters = ()
+        pass
     elif user.role == 'TEACHER':
-        filters = (Course.course_id.in_([x.course_id for x in user.taught_courses]),)
+        active_access = active_access.join(
+            Video,
+            Video.video_id == Access.video_id
+        ).filter(
+            Video.course_id.in_(list(get_auth_scope(user).course_ids))
+        )
     else:
         raise AssertionError
-    return filter_users_query(session.query(User), filters)
+    return session.query(User).filter(
+        active_access.exists()
+    ).order_by(User.registration_date.desc(),
+               User.user_id.desc())
 
 
 def get_multiple_users_with_course_for_current_user():
-    return filter_users_query(session.query(User, Course))
-
-
-def filter_users_query(query, filters=()):
-    return query.join(
-        Access,
-        Access.user_id == User.user_id
-    ).filter(
-        *get_current_active_filters()
+    """
+    Pairs of users and courses they have active access to, one row per pair.
+    """
+    active_courses = session.query(
+        Access.user_id,
+        Video.course_id
     ).join(
         Video,
         Video.video_id == Access.video_id
+    ).filter(
+        *get_current_active_filters()
+    ).distinct().subquery()
+    return session.query(*user_columns, *course_columns).join(
+        active_courses,
+        active_courses.c.user_id == User.user_id
     ).join(
         Course,
-        Course.course_id == Video.course_id
-    ).filter(
-        *filters
+        Course.course_id == active_courses.c.course_id
     ).order_by(User.registration_date.desc(),
-               Access.end_date.desc())
+               User.user_id.desc(),
+               Course.course_id)
 
 
 def get_teacher_with_courses(teacher_id, user):
@@ -146,15 +203,14 @@ def get_teacher_with_courses(teacher_id, user):
     if user.role == 'ADMIN':
         return True, teacher_db
     else:
-        if len(set(x.course_id for x in teacher_db.taught_courses).intersection(
-                set(x.course_id for x in user.taught_courses))) == 0:
+        if not get_auth_scope(teacher_db).course_ids & get_auth_scope(user).course_ids:
             return False, (403, 'Access denied')
     return True, teacher_db
 
 
 def get_multiple_teachers_with_courses(course_ids):
-    query = session.query(User,
-                          db.func.count(Course.course_id),
+    query = session.query(*user_columns,
+                          db.func.count(Course.course_id).label('courses_count'),
                           )
     if course_ids is not None:
         query = query.filter(Course.course_id.in_(course_ids))
@@ -177,10 +233,14 @@ def get_course_applications_by_id(app_id):
 
 def add_course_application(data):
     data['is_registered'] = True if email_exists(data['email']) else False
-    get_course_by_id(data['course_id'])
+    course = get_course_by_id(data['course_id'])
     application = CourseApplication(**data)
     session.add(application)
+    send_email('course_application', application.email,
+               name=format_greeting_name(application.name),
+               course_title=course.title)
     session.commit()
+    statistics_counters.add('pending_applications')
     return application
 
 
@@ -188,6 +248,7 @@ def delete_course_application(app_id):
     application = get_course_applications_by_id(app_id)
     session.delete(application)
     session.commit()
+    statistics_counters.add('pending_applications', -1)
 
 
 def get_course_by_id(course_id):
@@ -222,7 +283,7 @@ def get_course_ids_available_for_student(user):
 def get_available_courses_as_query_for_student(user):
     available_course_ids = get_course_ids_available_for_student(user)
     course_track_items = session.query(
-        Course, CourseProgressTracking
+        *course_columns, CourseProgressTracking.progress_percent
     ).filter(
         Course.course_id.in_(available_course_ids)
     ).join(
@@ -266,7 +327,6 @@ def get_course_by_id_if_available(course_id, user):
     course.available_videos = add_progress_percent(
         get_available_videos_by_student_and_course_with_progress(user, course_id))
 
-    course.video_count = len(course.videos)
     if course.available_videos:
         return True, course
     else:
@@ -275,8 +335,11 @@ def get_course_by_id_if_available(course_id, user):
 
 def delete_course(course_id):
     course = get_course_by_id(course_id)
+    teacher_ids = [x.user_id for x in course.teachers]
     session.delete(course)
     session.commit()
+    auth_scope_cache.invalidate(teacher_ids)
+    pricing_catalog.invalidate()
 
 
 def create_new_course(data):
@@ -301,9 +364,12 @@ def create_new_course(data):
                     course_products=[CourseProduct(**course_product_data) for course_product_data in course_products],
                     service_products=[ServiceProduct(**service_product_data) for service_product_data in
                                       service_products],
-                    videos=videos_db)
+                    videos=videos_db,
+                    video_count=len(videos_db))
     session.add(course)
     session.commit()
+    auth_scope_cache.invalidate([x.user_id for x in teachers])
+    pricing_catalog.invalidate()
 
     return course, 200, None
 
@@ -312,9 +378,11 @@ def patch_course(course_id, data):
     course_db = get_course_by_id(course_id)
     videos = data.pop('videos', [])
     teacher_ids = data.pop('teacher_ids', None)
+    changed_teacher_ids = set()
     if teacher_ids is not None:
+        changed_teacher_ids = {x.user_id for x in course_db.teachers} ^ set(teacher_ids)
         course_db.teachers = [get_user(user_id) for user_id
-                           in teacher_ids]
+                              in teacher_ids]
     new_landing_info = data.pop('landing_info', None)
     if new_landing_info is not None:
         land_info = {}
@@ -351,6 +419,8 @@ def patch_course(course_id, data):
             setattr(video, field, value)
 
     session.commit()
+    auth_scope_cache.invalidate(changed_teacher_ids)
+    pricing_catalog.invalidate()
 
     return course_db, 200, None
 
@@ -372,15 +442,43 @@ def create_registration_hash_and_send_email(data):
         return False, ''
     user_reg = create_database_item(UserRegistration, data)
     user_reg.hash = generate_token()
+    user_reg.last_email_date = datetime.now()
     session.add(user_reg)
+    send_registration_email(user_reg)
     session.commit()
-    # TODO: send email
     return True, user_reg.hash
 
 
-def create_payment_link(order_id):
-    # TODO: acquiring
-    return '/api/v1/payments/callback/{}'.format(order_id)
+def resend_registration_email(email):
+    """
+    Sends the registration email again, at most once per REGISTRATION_RESEND_INTERVAL_SECONDS for an email.
+    The result is not returned, so that callers can't find out which emails have a pending registration.
+    """
+    now = datetime.now()
+    allowed = UserRegistration.query.filter(
+        UserRegistration.email == email,
+        or_(UserRegistration.last_email_date.is_(None),
+            UserRegistration.last_email_date <= now - timedelta(
+                seconds=app.config['REGISTRATION_RESEND_INTERVAL_SECONDS']))
+    ).update({UserRegistration.last_email_date: now}, synchronize_session=False)
+    if allowed:
+        send_registration_email(UserRegistration.query.get(email))
+    session.commit()
+
+
+def send_registration_email(user_reg):
+    send_email('registration_hash', user_reg.email,
+               name=format_greeting_name(user_reg.name),
+               link=app.config['FRONTEND_URL'].rstrip('/') + app.config['REGISTRATION_URL'].format(hash=user_reg.hash))
+
+
+def format_greeting_name(name):
+    return ', {}'.format(name) if name else ''
+
+
+def create_payment_link(order_id, amount):
+    return payment_gateway.create_payment_link(order_id, amount,
+                                               app.config['PAYMENT_CALLBACK_URL'].format(order_id=order_id))
 
 
 def get_order(order_id):
@@ -389,13 +487,41 @@ def get_order(order_id):
 
 def get_user_product_ids(user, for_what):
     assert for_what in ('course', 'service')
-    product_id = '{}_product_id'.format(for_what)
-    product_items = '{}_product_items'.format(for_what)
-    return set(
-        getattr(product_item, product_id)
-        for order in user.orders if order.status == 'PAYED'
-        for product_item in getattr(order, product_items)
+    item_cls = OrderCourseProductItem if for_what == 'course' else OrderServiceProductItem
+    product_id = getattr(item_cls, '{}_product_id'.format(for_what))
+    return set(p_id for p_id, in session.query(
+        product_id
+    ).join(
+        Order,
+        Order.order_id == item_cls.order_id
+    ).filter(
+        Order.user_id == user.user_id,
+        Order.status == 'PAYED'
+    ).distinct())
+
+
+def get_orders(user_id=None, status=None, begin_date=None, end_date=None, before=None, size=None):
+    """
+    Returns orders newest first with their items.
+    Keyset pagination: pass order_id of the last order of a page as `before` to get the next page.
+    """
+    if size is None:
+        size = app.config['ORDERS_PAGE_SIZE']
+    query = Order.query.options(
+        selectinload(Order.course_product_items),
+        selectinload(Order.service_product_items)
     )
+    if user_id is not None:
+        query = query.filter(Order.user_id == user_id)
+    if status is not None:
+        query = query.filter(Order.status == status)
+    if begin_date is not None:
+        query = query.filter(Order.order_date >= begin_date)
+    if end_date is not None:
+        query = query.filter(Order.order_date < end_date)
+    if before is not None:
+        query = query.filter(Order.order_id < before)
+    return query.order_by(Order.order_id.desc()).limit(size).all()
 
 
 def check_purchased_course_product_ids(user, course_product_ids):
@@ -413,37 +539,107 @@ def create_order(user, data):
     if len(course_product_ids) + len(service_product_ids) == 0:
         return False, (400, 'Cart is empty')
 
-    course_products = [CourseProduct.query.get_or_404(p_id) for p_id in course_product_ids]
-    service_products = [ServiceProduct.query.get_or_404(p_id) for p_id in service_product_ids]
+    ok, course_products = get_products(CourseProduct, CourseProduct.course_product_id, course_product_ids)
+    if not ok:
+        return False, (404, 'Course product(s) not found: {}'.format(course_products))
+    ok, service_products = get_products(ServiceProduct, ServiceProduct.service_product_id, service_product_ids)
+    if not ok:
+        return False, (404, 'Service product(s) not found: {}'.format(service_products))
+
+    ok, promo = get_promo_code(data.get('promocode'))
+    if not ok:
+        return False, (400, 'Invalid promocode')
 
+    cart = price_cart(course_products, service_products, promo)
     data['course_product_items'] = [OrderCourseProductItem(
-        price=pr.price,
-        course_product_id=pr.course_product_id
-    ) for pr in course_products]
+        price=item['discounted_price'],
+        course_product_id=item['course_product_id']
+    ) for item in cart['course_products']]
     data['service_product_items'] = [OrderServiceProductItem(
-        price=pr.price,
-        service_product_id=pr.service_product_id
-    ) for pr in service_products]
+        price=item['discounted_price'],
+        service_product_id=item['service_product_id']
+    ) for item in cart['service_products']]
 
-    data['price'] = sum(pr.price for pr in course_products + service_products)
+    data['price'] = cart['total']
+    data['promocode'] = cart['promocode']
     data['user_id'] = user.user_id
 
     order = create_database_item(Order, data)
     session.add(order)
+    session.flush()
+    order_id = order.order_id
+    amount = order.price
     session.commit()
 
+    # No transaction is open while waiting for the payment provider
     try:
-        link = create_payment_link(order_id=order.order_id)
+        link = create_payment_link(order_id, amount)
     except Exception:
-        order.status = 'FAILED'
-        session.commit()
+        update_order(order_id, status='FAILED')
         return False, (503, 'Payment operational error')
 
-    order.payment_link = link
-    session.commit()
+    update_order(order_id, payment_link=link)
     return True, order
 
 
+def get_products(cls, primary_key, product_ids):
+    """
+    Loads products with one query.
+    :return: (True, products in order of product_ids) or (False, sorted missing ids)
+    """
+    if not product_ids:
+        return True, []
+    products = {getattr(pr, primary_key.key): pr for pr in cls.query.filter(primary_key.in_(set(product_ids))).all()}
+    missing_ids = set(product_ids) - set(products)
+    if missing_ids:
+        return False, sorted(missing_ids)
+    return True, [products[p_id] for p_id in product_ids]
+
+
+def get_promo_code(promocode):
+    """
+    :return: (True, active PromoCode or None if no promocode given) or (False, None)
+    """
+    if not promocode:
+        return True, None
+    promo = PromoCode.query.get(promocode.strip())
+    if promo is None or not is_promo_active(promo):
+        return False, None
+    return True, promo
+
+
+def get_cart_quote(data):
+    """
+    Prices the cart using the in-memory pricing catalog, without product queries.
+    """
+    catalog = pricing_catalog.get_snapshot()
+    ok, course_products = get_catalog_products(catalog.course_products, data.get('course_product_ids') or [])
+    if not ok:
+        return False, (404, 'Course product(s) not found: {}'.format(course_products))
+    ok, service_products = get_catalog_products(catalog.service_products, data.get('service_product_ids') or [])
+    if not ok:
+        return False, (404, 'Service product(s) not found: {}'.format(service_products))
+    promo = None
+    promocode = data.get('promocode')
+    if promocode:
+        promo = catalog.promocodes.get(promocode.strip().upper())
+        if promo is None or not is_promo_active(promo):
+            return False, (400, 'Invalid promocode')
+    return True, price_cart(course_products, service_products, promo)
+
+
+def get_catalog_products(catalog_products, product_ids):
+    missing_ids = set(product_ids) - set(catalog_products)
+    if missing_ids:
+        return False, sorted(missing_ids)
+    return True, [catalog_products[p_id] for p_id in product_ids]
+
+
+def update_order(order_id, **values):
+    Order.query.filter(Order.order_id == order_id).update(values, synchronize_session=False)
+    session.commit()
+
+
 def create_access_items(course_product, user_id):
     course_videos = course_product.course.videos
     interval = 2
@@ -465,7 +661,16 @@ def get_timing(items, interval):
 
 
 def grant_access_for_payed_order(order_id):
+    """
+    Idempotent: the order is moved from CREATED to PAYED by a conditional update,
+    so concurrent or retried callbacks grant access only once and get the same result.
+    """
+    result = processed_payment_callbacks.get(order_id)
+    if result is not None:
+        return result
     order = get_order(order_id)
+    if order.status != 'CREATED':
+        return get_processed_callback_result(order_id, order.status)
     access_items = []
     purchased_course_product_ids = check_purchased_course_product_ids(order.user,
                                                                       [x.course_product_id
@@ -478,20 +683,43 @@ def grant_access_for_payed_order(order_id):
                             'course: {}, service: {}'.format(purchased_course_product_ids,
                                                              purchased_service_product_ids))
 
+    # Claim the order before anything is added to the session: the update autoflushes pending rows.
+    # A concurrent callback waits here on the row lock and then finds the order PAYED.
+    claimed = Order.query.filter(
+        Order.order_id == order_id,
+        Order.status == 'CREATED'
+    ).update({Order.status: 'PAYED'}, synchronize_session=False)
+    if not claimed:
+        session.rollback()
+        status = session.query(Order.status).filter(Order.order_id == order_id).with_for_update().scalar()
+        session.rollback()
+        return get_processed_callback_result(order_id, status)
+
     for course_product_item in order.course_product_items:
-        access_items += create_access_items(course_product_item.course_product,
-                                            order.user_id)
+        course_access_items = create_access_items(course_product_item.course_product,
+                                                  order.user_id)
+        course_progress = get_or_create_course_progress(order.user_id,
+                                                        course_product_item.course_product.course_id)
+        course_progress.video_count = (course_progress.video_count or 0) + len(course_access_items)
+        access_items += course_access_items
+
     # TODO deactivate link + remove existing orders for the same course product/service product
     session.add_all(access_items)
-    order.status = 'PAYED'
+    old_role_and_status = order.user.role, order.user.status
     order.user.status = 'ACTIVE'
-
-    for course_product_item in order.course_product_items:
-        course_progress = get_course_progress(order.user_id, course_product_item.course_product.course_id)
-        if course_progress is not None:
-            update_course_progress_video_count(course_progress)
+    price = order.price
     session.commit()
-    return True, {}
+    track_user_statistics(old_role_and_status, (old_role_and_status[0], 'ACTIVE'))
+    statistics_counters.add_all({'revenue': price or 0, 'payed_orders': 1})
+    return get_processed_callback_result(order_id, 'PAYED')
+
+
+def get_processed_callback_result(order_id, status):
+    if status != 'PAYED':
+        return False, (409, 'Order is not awaiting payment')
+    result = True, {}
+    processed_payment_callbacks.add(order_id, result)
+    return result
 
 
 def get_course_progress(user_id, course_id):
@@ -501,6 +729,34 @@ def get_course_progress(user_id, course_id):
     ).one_or_none()
 
 
+def count_accessible_videos(user_id, course_id):
+    return session.query(
+        db.func.count(Access.access_id)
+    ).join(
+        Video,
+        Video.video_id == Access.video_id
+    ).filter(
+        Access.user_id == user_id,
+        Video.course_id == course_id
+    ).scalar()
+
+
+def get_or_create_course_progress(user_id, course_id):
+    """
+    A new row starts with the number of videos the user already has access to,
+    e.g. for students who got access before course progress was tracked.
+    """
+    course_progress = get_course_progress(user_id, course_id)
+    if course_progress is None:
+        course_progress = CourseProgressTracking(
+            course_id=course_id,
+            user_id=user_id,
+            video_count=count_accessible_videos(user_id, course_id)
+        )
+        session.add(course_progress)
+    return course_progress
+
+
 def update_video_progress(user, data):
     video = get_video_by_id(data['video_id'])
     video_progress = VideoProgressTracking.query.filter(
@@ -508,15 +764,8 @@ def update_video_progress(user, data):
         VideoProgressTracking.user_id == user.user_id
     ).one_or_none()
     if video_progress is None:
-        course_progress = get_course_progress(user.user_id,
-                                              video.course_id)
-        if course_progress is None:
-            course_progress = CourseProgressTracking(
-                course_id=video.course_id,
-                user_id=user.user_id
-            )
-            update_course_progress_video_count(course_progress)
-            session.add(course_progress)
+        course_progress = get_or_create_course_progress(user.user_id,
+                                                        video.course_id)
         video_progress = VideoProgressTracking(
             video_id=video.video_id,
             user_id=user.user_id,
@@ -529,33 +778,89 @@ def update_video_progress(user, data):
         video_progress.progress_percent = new_progress
         update_course_progress(video_progress.course_progress)
         if video_progress.progress_percent == 100:
-            send_hw(user.user_id,
-                    course_id=video.course_id,
-                    video_id=video.video_id,
-                    homework=video.homework
-                    )
+            enqueue_job('send_hw', {
+                'user_id': user.user_id,
+                'course_id': video.course_id,
+                'video_id': video.video_id,
+            }, commit=False)
     session.commit()
     return video_progress
 
 
-def update_course_progress_video_count(course_progress):
-    course_progress.video_count = Access.query.filter(
-        Access.user_id == course_progress.user_id,
-    ).join(
-        Video,
-        Access.video
-    ).filter(
-        Video.course_id == course_progress.course_id
-    ).count()
-
-
 def update_course_progress(course_progress):
+    if not course_progress.video_count:
+        return
     course_progress.progress_percent = round(sum(
         video_progress.progress_percent
         for video_progress in course_progress.video_progress_items
     ) / course_progress.video_count)
 
 
+def fix_video_counts():
+    """
+    Consistency check for denormalized video counters.
+    Recounts courses.video_count and course_progress.video_count and fixes the rows that drifted.
+    :return: (number of fixed courses, number of fixed course progress rows)
+    """
+    course_video_count = db.select(
+        db.func.count(Video.video_id)
+    ).where(
+        Video.course_id == Course.course_id
+    ).scalar_subquery()
+    fixed_courses = session.query(Course).filter(
+        Course.video_count != course_video_count
+    ).update({Course.video_count: course_video_count}, synchronize_session=False)
+
+    accessible_video_count = db.select(
+        db.func.count(Access.access_id)
+    ).join(
+        Video,
+        Video.video_id == Access.video_id
+    ).where(
+        Access.user_id == CourseProgressTracking.user_id,
+        Video.course_id == CourseProgressTracking.course_id
+    ).scalar_subquery()
+    fixed_progress = session.query(CourseProgressTracking).filter(
+        db.func.coalesce(CourseProgressTracking.video_count, -1) != accessible_video_count
+    ).update({CourseProgressTracking.video_count: accessible_video_count}, synchronize_session=False)
+    session.commit()
+    return fixed_courses, fixed_progress
+
+
+def fix_last_chat_lines():
+    """
+    Fills last_chat_line_id, last_sender and last_message_date of chat threads which have chat lines
+    but no last chat line, e.g. threads created before these columns were added.
+    :return: number of fixed chat threads
+    """
+    last_chat_line_id = db.select(
+        db.func.max(ChatLine.chat_line_id)
+    ).where(
+        ChatLine.chat_thread_id == ChatThread.chat_thread_id
+    ).scalar_subquery()
+    fixed = session.query(ChatThread).filter(
+        ChatThread.last_chat_line_id.is_(None),
+        last_chat_line_id.isnot(None)
+    ).update({ChatThread.last_chat_line_id: last_chat_line_id}, synchronize_session=False)
+
+    def last_chat_line_field(field):
+        return db.select(
+            field
+        ).where(
+            ChatLine.chat_line_id == ChatThread.last_chat_line_id
+        ).scalar_subquery()
+
+    session.query(ChatThread).filter(
+        ChatThread.last_chat_line_id.isnot(None),
+        ChatThread.last_sender.is_(None)
+    ).update({
+        ChatThread.last_sender: last_chat_line_field(ChatLine.sender),
+        ChatThread.last_message_date: last_chat_line_field(ChatLine.message_date),
+    }, synchronize_session=False)
+    session.commit()
+    return fixed
+
+
 def round_progress_percent(progress):
     return 100 if progress >= 95 else progress
 
@@ -570,22 +875,52 @@ def get_chats_for_student(current_user):
     ).all()
 
 
-def get_chats_for_teacher(current_user):
-    if current_user.role == 'ADMIN':
-        chats = Chat.query.all()
-    else:
-        chats = Chat.query.join(
-            Course,
-            Chat.course
-        ).join(
-            User,
-            Course.teachers
+def get_teacher_chats_filters(current_user):
+    scope = get_auth_scope(current_user)
+    if scope.is_admin:
+        return []
+    return [Chat.course_id.in_(list(scope.course_ids))]
+
+
+def get_chats_for_teacher(current_user, page=1, size=0, offset=0, unread=False):
+    """
+    Teacher inbox: chats grouped by course, most recent first.
+    page, size and offset are applied to each course separately (see PaginationMixin.paginate).
+    :param unread: return only chats with unread messages for teacher
+    """
+    filters = get_teacher_chats_filters(current_user)
+    if unread:
+        filters.append(Chat.teacher_read.is_(False))
+    order_clauses = (Chat.last_message_date.desc(), Chat.chat_id.desc())
+
+    query = Chat.query.filter(*filters)
+    if size or offset:
+        position = db.func.row_number().over(
+            partition_by=Chat.course_id,
+            order_by=order_clauses
+        ).label('position')
+        ranked_chats = session.query(Chat.chat_id, position).filter(*filters).subquery()
+        start = offset + size * (page - 1) if size else offset
+        position_filters = [ranked_chats.c.position > start]
+        if size:
+            position_filters.append(ranked_chats.c.position <= start + size)
+        query = Chat.query.join(
+            ranked_chats,
+            ranked_chats.c.chat_id == Chat.chat_id
         ).filter(
-            User.user_id == current_user.user_id
-        ).distinct().all()
+            *position_filters
+        )
+    chats = query.options(
+        joinedload(Chat.student),
+        selectinload(Chat.course)
+    ).order_by(
+        Chat.course_id,
+        *order_clauses
+    ).all()
+
     result = []
-    for course_id in set(chat.course_id for chat in chats):
-        course_chats = [x for x in chats if x.course_id == course_id]
+    for course_id, course_chats in groupby(chats, key=attrgetter('course_id')):
+        course_chats = list(course_chats)
         result.append({
             'course': course_chats[0].course,
             'chats': course_chats,
@@ -593,6 +928,41 @@ def get_chats_for_teacher(current_user):
     return result
 
 
+def get_unread_counters(current_user, sender):
+    """
+    Numbers of unread chat threads per chat and per course, computed with a single aggregate query.
+    """
+    if sender == 'TEACHER':
+        filters = get_teacher_chats_filters(current_user)
+        read_field = ChatThread.teacher_read
+    else:
+        filters = [Chat.student_id == current_user.user_id]
+        read_field = ChatThread.student_read
+    rows = session.query(
+        Chat.chat_id,
+        Chat.course_id,
+        db.func.count(ChatThread.chat_thread_id).label('unread_threads')
+    ).join(
+        ChatThread,
+        ChatThread.chat_id == Chat.chat_id
+    ).filter(
+        *filters,
+        read_field.isnot(True)
+    ).group_by(
+        Chat.chat_id,
+        Chat.course_id
+    ).all()
+    courses = {}
+    for row in rows:
+        courses[row.course_id] = courses.get(row.course_id, 0) + row.unread_threads
+    return {
+        'unread_threads': sum(courses.values()),
+        'courses': [{'course_id': course_id, 'unread_threads': count} for course_id, count in courses.items()],
+        'chats': [{'chat_id': row.chat_id, 'course_id': row.course_id, 'unread_threads': row.unread_threads}
+                  for row in rows],
+    }
+
+
 def update_chat_and_thread_read_status(chat_thread, sender, is_new_message=False):
     update_read_status(chat_thread, sender, is_new_message)
     update_read_status(chat_thread.chat, sender, is_new_message)
@@ -609,7 +979,62 @@ def update_read_status(obj, sender, is_new_message=False):
             obj.teacher_read = False
 
 
-def get_chat_items_by_chat_id(current_user, chat_id, sender):
+def mark_chat_read(chat, sender):
+    """
+    Marks the chat, its threads and the last lines of the other side as read by sender.
+    Only rows which are not read yet are updated, no writes are issued if everything is read.
+    :return int: number of updated rows
+    """
+    read_field = 'teacher_read' if sender == 'TEACHER' else 'student_read'
+    updated = 0
+    if not getattr(chat, read_field):
+        updated += Chat.query.filter(
+            Chat.chat_id == chat.chat_id,
+            getattr(Chat, read_field).isnot(True)
+        ).update({read_field: True}, synchronize_session=False)
+
+    unread_threads = session.query(
+        ChatThread.chat_thread_id
+    ).filter(
+        ChatThread.chat_id == chat.chat_id,
+        getattr(ChatThread, read_field).isnot(True)
+    )
+    unread_last_lines = session.query(
+        ChatLine.chat_line_id
+    ).join(
+        ChatThread,
+        ChatThread.last_chat_line_id == ChatLine.chat_line_id
+    ).filter(
+        ChatThread.chat_id == chat.chat_id,
+        ChatThread.last_sender != sender,
+        ChatLine.is_read.isnot(True)
+    )
+    has_unread_threads, has_unread_last_lines = session.query(
+        unread_threads.exists(),
+        unread_last_lines.exists()
+    ).one()
+
+    if has_unread_threads:
+        updated += ChatThread.query.filter(
+            ChatThread.chat_id == chat.chat_id,
+            getattr(ChatThread, read_field).isnot(True)
+        ).update({read_field: True}, synchronize_session=False)
+    if has_unread_last_lines:
+        updated += ChatLine.query.filter(
+            ChatLine.chat_line_id.in_(
+                session.query(
+                    ChatThread.last_chat_line_id
+                ).filter(
+                    ChatThread.chat_id == chat.chat_id,
+                    ChatThread.last_sender != sender
+                )
+            ),
+            ChatLine.is_read.isnot(True)
+        ).update({ChatLine.is_read: True}, synchronize_session=False)
+    return updated
+
+
+def get_chat_items_by_chat_id(current_user, chat_id, sender, size=None):
     chat = Chat.query.get_or_404(chat_id)
     if not check_sender(current_user=current_user,
                         chat=chat,
@@ -617,19 +1042,74 @@ def get_chat_items_by_chat_id(current_user, chat_id, sender):
         return False, (403, 'Access denied')
     # Don't update read status if admin is watching...
     if sender != 'TEACHER' or current_user.role != 'ADMIN':
-        update_read_status(chat, sender, False)
-        for chat_thread in chat.chat_threads:
-            update_read_status(chat_thread, sender, False)
-            if chat_thread.chat_lines[-1].sender != sender:
-                chat_thread.chat_lines[-1].is_read = True
-        session.commit()
-    return True, chat.chat_threads
+        if mark_chat_read(chat, sender):
+            session.commit()
+    chat_threads = ChatThread.query.filter(
+        ChatThread.chat_id == chat.chat_id
+    ).options(
+        selectinload(ChatThread.video)
+    ).order_by(
+        ChatThread.chat_thread_id
+    ).all()
+    return True, add_recent_chat_lines(chat_threads, size)
+
+
+def add_recent_chat_lines(chat_threads, size=None):
+    """
+    Attaches the last `size` chat lines (in chronological order) to each chat thread as `recent_chat_lines`.
+    Older lines can be fetched with get_chat_lines using the first chat_line_id as a cursor.
+    """
+    if size is None:
+        size = app.config['CHAT_LINES_PAGE_SIZE']
+    position = db.func.row_number().over(
+        partition_by=ChatLine.chat_thread_id,
+        order_by=ChatLine.chat_line_id.desc()
+    ).label('position')
+    ranked_lines = session.query(
+        ChatLine.chat_line_id,
+        position
+    ).filter(
+        ChatLine.chat_thread_id.in_([x.chat_thread_id for x in chat_threads])
+    ).subquery()
+    chat_lines = ChatLine.query.join(
+        ranked_lines,
+        ranked_lines.c.chat_line_id == ChatLine.chat_line_id
+    ).filter(
+        ranked_lines.c.position <= size
+    ).order_by(
+        ChatLine.chat_thread_id,
+        ChatLine.chat_line_id
+    ).all() if chat_threads else []
+    lines_by_thread = {chat_thread_id: list(thread_lines) for chat_thread_id, thread_lines
+                       in groupby(chat_lines, key=attrgetter('chat_thread_id'))}
+    for chat_thread in chat_threads:
+        chat_thread.recent_chat_lines = lines_by_thread.get(chat_thread.chat_thread_id, [])
+    return chat_threads
+
+
+def get_chat_lines(current_user, chat_thread_id, before=None, size=None):
+    """
+    Returns chat lines of the thread older than `before` (chat_line_id), newest `size` of them
+    in chronological order.
+    """
+    chat_thread = get_chat_thread(chat_thread_id)
+    chat = chat_thread.chat
+    sender = 'STUDENT' if current_user.user_id == chat.student_id else 'TEACHER'
+    if not check_sender(current_user=current_user,
+                        chat=chat,
+                        sender=sender):
+        return False, (403, 'Access denied')
+    if size is None:
+        size = app.config['CHAT_LINES_PAGE_SIZE']
+    query = ChatLine.query.filter(ChatLine.chat_thread_id == chat_thread.chat_thread_id)
+    if before is not None:
+        query = query.filter(ChatLine.chat_line_id < before)
+    chat_lines = query.order_by(ChatLine.chat_line_id.desc()).limit(size).all()
+    return True, chat_lines[::-1]
 
 
 def check_teacher_able_to_send(current_user, chat):
-    if current_user.role == 'ADMIN':
-        return True
-    return current_user.user_id in {x.user_id for x in chat.course.teachers}
+    return get_auth_scope(current_user).can_teach(chat.course_id)
 
 
 def check_sender(current_user, chat, sender):
@@ -648,11 +1128,12 @@ def check_non_empty_message(message):
 
 def add_chat_line(current_user, body):
     chat_thread = get_chat_thread(body.pop('chat_thread_id'))
+    load_last_chat_line(chat_thread)
     if chat_thread.hw_status == 'APPROVED':
         return False, (400, 'HW is already approved')
     sender = body['sender']
     hw_status = body.get('hw_status', None)
-    if chat_thread.chat_lines[-1].sender == sender or \
+    if chat_thread.last_sender == sender or \
             not check_sender(current_user=current_user,
                              chat=chat_thread.chat,
                              sender=sender
@@ -661,9 +1142,11 @@ def add_chat_line(current_user, body):
     if sender == 'TEACHER' and hw_status is None:
         return False, (400, '"hw_status" must be either APPROVED or NOT_APPROVED')
     message = body.get('message', None)
+    event = None
     if check_non_empty_message(message):
-        create_chat_line(chat_thread, sender, message)
-        chat_thread.chat.last_message_date = datetime.now()
+        chat_line = create_chat_line(chat_thread, sender, message)
+        event = get_chat_line_event(chat_line)
+        chat_thread.chat.last_message_date = chat_line.message_date
         update_chat_and_thread_read_status(chat_thread, sender, True)
     else:
         if sender != 'TEACHER':
@@ -671,28 +1154,66 @@ def add_chat_line(current_user, body):
         elif hw_status != 'APPROVED':
             return False, (400, 'No comments provided')
         else:
-            chat_thread.chat_lines[-1].is_read = True
+            mark_last_chat_line_read(chat_thread)
     if sender == 'STUDENT':
         chat_thread.hw_status = 'PENDING'
     else:
         chat_thread.hw_status = hw_status
     session.commit()
-    return True, chat_thread
+    if event is not None:
+        chat_event_bus.publish(event)
+    return True, add_recent_chat_lines([chat_thread])[0]
+
+
+def load_last_chat_line(chat_thread):
+    """
+    Fallback for threads not yet fixed by fix_last_chat_lines.
+    """
+    if chat_thread.last_chat_line_id is None:
+        chat_line = ChatLine.query.filter(
+            ChatLine.chat_thread_id == chat_thread.chat_thread_id
+        ).order_by(
+            ChatLine.chat_line_id.desc()
+        ).first()
+        if chat_line is not None:
+            set_last_chat_line(chat_thread, chat_line)
+
+
+def set_last_chat_line(chat_thread, chat_line):
+    chat_thread.last_chat_line_id = chat_line.chat_line_id
+    chat_thread.last_sender = chat_line.sender
+    chat_thread.last_message_date = chat_line.message_date
+
+
+def mark_last_chat_line_read(chat_thread):
+    load_last_chat_line(chat_thread)
+    if chat_thread.last_chat_line_id is not None:
+        ChatLine.query.filter(
+            ChatLine.chat_line_id == chat_thread.last_chat_line_id
+        ).update({ChatLine.is_read: True}, synchronize_session=False)
 
 
 def create_chat_line(chat_thread, sender, message):
-    if len(chat_thread.chat_lines) > 0:
-        chat_thread.chat_lines[-1].is_read = True
+    mark_last_chat_line_read(chat_thread)
     chat_line = ChatLine(
         chat_thread=chat_thread,
         sender=sender,
-        message=message
+        message=message,
+        message_date=datetime.now()
     )
     session.add(chat_line)
+    session.flush()
+    set_last_chat_line(chat_thread, chat_line)
     return chat_line
 
 
-def send_hw(user_id, course_id, video_id, homework):
+@job_handler(max_attempts=3)
+def send_hw(user_id, course_id, video_id):
+    """
+    Sends homework of the video to the student. Runs as a background job.
+    Idempotent for (user_id, video_id): nothing is sent if the homework thread already exists.
+    """
+    homework = HomeWork.query.filter(HomeWork.video_id == video_id).one_or_none()
     if homework is not None:
         result = session.query(Chat, ChatThread).filter(
             Chat.student_id == user_id,
@@ -712,63 +1233,216 @@ def send_hw(user_id, course_id, video_id, homework):
             chat_thread = None
         else:
             chat, chat_thread = result
-        if chat_thread is None:
-            chat_thread = ChatThread(
-                chat=chat,
-                video_id=video_id,
-                hw_status=hw_statuses[0]
-            )
-            session.add(chat_thread)
-        create_chat_line(chat_thread, 'TEACHER', homework.homework_message)
-        session.commit()
+        if chat_thread is not None:
+            return
+        chat_thread = ChatThread(
+            chat=chat,
+            video_id=video_id,
+            hw_status=hw_statuses[0]
+        )
+        session.add(chat_thread)
+        try:
+            chat_line = create_chat_line(chat_thread, 'TEACHER', homework.homework_message)
+            event = get_chat_line_event(chat_line)
+            session.commit()
+        except IntegrityError:
+            # Homework was sent concurrently
+            session.rollback()
+            logger.info('Homework for user {} and video {} is already sent'.format(user_id, video_id))
+            return
+        chat_event_bus.publish(event)
+
+
+def get_chat_line_event(chat_line):
+    chat = chat_line.chat_thread.chat
+    return {
+        'event_id': chat_line.chat_line_id,
+        'chat_id': chat.chat_id,
+        'chat_thread_id': chat_line.chat_thread.chat_thread_id,
+        'course_id': chat.course_id,
+        'student_id': chat.student_id,
+        'sender': chat_line.sender,
+    }
+
+
+def get_chat_events_filter(current_user):
+    scope = get_auth_scope(current_user)
+    if scope.is_admin:
+        return lambda event: True
+    return lambda event: event['student_id'] == scope.user_id or event['course_id'] in scope.course_ids
+
+
+def wait_for_chat_events(current_user, since=None, timeout=None):
+    """
+    Long poll for new chat lines in chats available to the current user.
+    :param since: last event_id (chat_line_id) known to the client, defaults to the latest event
+    :param timeout: seconds to wait, bounded by CHAT_EVENTS_MAX_TIMEOUT
+    """
+    max_timeout = app.config['CHAT_EVENTS_MAX_TIMEOUT']
+    timeout = max_timeout if timeout is None else min(timeout, max_timeout)
+    matches = get_chat_events_filter(current_user)
+    # Don't hold a database connection while the request is parked
+    session.close()
+    if since is None:
+        since = chat_event_bus.last_event_id
+    events = chat_event_bus.wait(since, matches, timeout)
+    return {
+        'last_event_id': max([since] + [event['event_id'] for event in events]),
+        'events': events,
+    }
+
+
+def add_course_to_user(user_course_rows):
+    """
+    Converts rows of user and course columns to UserRow objects with nested course.
+    """
+    result = []
+    for row in user_course_rows:
+        values = row._asdict()
+        result.append(UserRow(course=CourseRow(**values), **values))
+    return result
 
 
-def add_field_to_obj(obj_list, key):
-    return [setattr(user, key, course) or user for user, course in obj_list]
+def get_statistics():
+    """
+    Statistics values including changes not yet flushed by this process
+    """
+    stats = {x.statistics_name: x.value for x in Statistics.query.all()}
+    for name, delta in statistics_counters.pending().items():
+        if name in stats:
+            stats[name] = max(stats[name] + delta, 0)
+    return stats
+
+
+def count_if(*conditions):
+    return db.func.coalesce(db.func.sum(case((and_(*conditions), 1), else_=0)), 0)
+
+
+def count_statistics():
+    user_stats = session.query(
+        count_if(User.role == 'STUDENT').label('registered_students'),
+        count_if(User.role == 'STUDENT', User.status == 'ACTIVE').label('studying'),
+        count_if(User.role == 'TEACHER').label('teachers'),
+    ).one()
+    return {
+        'registered_students': int(user_stats.registered_students),
+        'studying': int(user_stats.studying),
+        'pending_applications': session.query(db.func.count(CourseApplication.application_id)).scalar(),
+        'teachers': int(user_stats.teachers),
+    }
+
+
+def save_statistics(values):
+    stmt = insert(Statistics).values([{'statistics_name': name, 'value': value}
+                                      for name, value in values.items()])
+    session.execute(stmt.on_duplicate_key_update(value=stmt.inserted.value))
+    session.commit()
 
 
-def add_courses_to_user(user_list):
-    result = []
-    for user, c_ids, c_names in user_list:
-        courses = []
-        for c_id, c_name in zip(c_ids.split(','), c_names.split(',')):
-            course = type('', (), {})()
-            setattr(course, 'course_id', c_id)
-            setattr(course, 'title', c_name)
-            courses.append(course)
-        setattr(user, 'courses', courses)
-        result.append(user)
-    return result
+def count_sales():
+    sales = session.query(
+        db.func.coalesce(db.func.sum(Order.price), 0).label('revenue'),
+        db.func.count(Order.order_id).label('payed_orders')
+    ).filter(
+        Order.status == 'PAYED'
+    ).one()
+    return {
+        'revenue': int(sales.revenue),
+        'payed_orders': sales.payed_orders,
+    }
+
+
+def get_period_start(date, granularity):
+    if granularity == 'HOUR':
+        return date.replace(minute=0, second=0, microsecond=0)
+    elif granularity == 'DAY':
+        return date.replace(hour=0, minute=0, second=0, microsecond=0)
+    else:
+        raise ValueError(granularity)
+
+
+def save_metric_rollups(values, date):
+    """
+    Stores a snapshot into hourly and daily rollups. A later snapshot in the same period replaces the earlier one,
+    so each period keeps its last value.
+    """
+    stmt = insert(MetricRollup).values([{
+        'metric_name': name,
+        'granularity': granularity,
+        'period_start': get_period_start(date, granularity),
+        'value': value,
+    } for granularity in ('HOUR', 'DAY') for name, value in values.items()])
+    session.execute(stmt.on_duplicate_key_update(value=stmt.inserted.value))
+    session.commit()
+
+
+def delete_expired_metric_rollups(date):
+    deleted = 0
+    for granularity, retention_days in (('HOUR', app.config['METRICS_HOURLY_RETENTION_DAYS']),
+                                        ('DAY', app.config['METRICS_DAILY_RETENTION_DAYS'])):
+        deleted += MetricRollup.query.filter(
+            MetricRollup.granularity == granularity,
+            MetricRollup.period_start < date - timedelta(days=retention_days)
+        ).delete(synchronize_session=False)
+    session.commit()
+    return deleted
+
+
+def get_metric_rollups(metric_names=None, granularity='DAY', begin_date=None, end_date=None):
+    filters = [MetricRollup.granularity == granularity]
+    if metric_names:
+        filters.append(MetricRollup.metric_name.in_(metric_names))
+    if begin_date is not None:
+        filters.append(MetricRollup.period_start >= get_period_start(begin_date, granularity))
+    if end_date is not None:
+        filters.append(MetricRollup.period_start <= end_date)
+    return MetricRollup.query.filter(
+        *filters
+    ).order_by(
+        MetricRollup.metric_name,
+        MetricRollup.period_start
+    ).all()
 
 
-def add_course_to_user(user_course_list):
-    return add_field_to_obj(user_course_list, 'course')
+def get_missing_statistics_names():
+    return set(statistics_names) - {name for name, in session.query(Statistics.statistics_name)}
 
 
-def get_statistics():
-    stats = Statistics.query.all()
-    return {x.statistics_name: x.value for x in stats}
+def flush_statistics():
+    if get_missing_statistics_names():
+        # Counters are not initialized yet, e.g. revenue after an upgrade: deltas can't be applied to them
+        collect_statistics()
+        return {}
+    return statistics_counters.flush()
+
+
+def snapshot_statistics():
+    """
+    Saves current statistics values into metric rollups without recounting tables.
+    """
+    values = {x.statistics_name: x.value for x in Statistics.query.all()}
+    if set(statistics_names) - set(values):
+        # Counters are not initialized yet
+        collect_statistics()
+    else:
+        save_metric_rollups(values, datetime.now())
+    delete_expired_metric_rollups(datetime.now())
 
 
 def collect_statistics():
-    for name in ('registered_students', 'studying', 'pending_applications', 'teachers'):
-        stats_db = Statistics.query.get(name)
-        if stats_db is None:
-            stats_db = Statistics(statistics_name=name)
-            session.add(stats_db)
-        if name == 'registered_students':
-            value = User.query.filter(User.role == 'STUDENT').distinct(User.user_id).count()
-        elif name == 'studying':
-            value = User.query.filter(User.status == 'ACTIVE',
-                                      User.role == 'STUDENT').distinct(User.user_id).count()
-        elif name == 'pending_applications':
-            value = CourseApplication.query.distinct(CourseApplication.application_id).count()
-        elif name == 'teachers':
-            value = User.query.filter(User.role == 'TEACHER').distinct(User.user_id).count()
-        else:
-            raise ValueError(name)
-        stats_db.value = value
+    """
+    Reconciliation: recounts all statistics from the tables, fixing any drift of event-driven counters.
+    Pending changes of this process are dropped right before the recount, which includes them.
+    Changes committed between that and the recount, and changes not yet flushed by other processes
+    (at most STATISTICS_FLUSH_INTERVAL_SECONDS of events), are counted twice until the next reconciliation.
+    """
+    # Start a new transaction, so that the recount sees everything committed before the deltas are dropped
     session.commit()
+    statistics_counters.discard(statistics_names)
+    values = count_statistics()
+    values.update(count_sales())
+    save_statistics(values)
+    save_metric_rollups(values, datetime.now())
 
 
 #  NOTIFICATIONS
@@ -0,0 +1,51 @@
+from ip_app import app, scheduler, logger
+from .services import fix_video_counts, fix_last_chat_lines, collect_statistics, flush_statistics, snapshot_statistics
+from .maintenance import archive_inactive_users, collect_garbage
+
+
+@scheduler.task('interval', id='fix_video_counts', minutes=app.config['VIDEO_COUNTS_CHECK_INTERVAL_MINUTES'])
+def fix_video_counts_job():
+    with scheduler.app.app_context():
+        fixed_courses, fixed_progress = fix_video_counts()
+        if fixed_courses or fixed_progress:
+            logger.warning('Fixed video counts: {} courses, {} course progress rows'.format(fixed_courses,
+                                                                                           fixed_progress))
+
+
+# Runs once when the scheduler starts
+@scheduler.task('date', id='fix_last_chat_lines')
+def fix_last_chat_lines_job():
+    with scheduler.app.app_context():
+        fixed = fix_last_chat_lines()
+        if fixed:
+            logger.warning('Filled last chat lines of {} chat threads'.format(fixed))
+
+
+@scheduler.task('interval', id='flush_statistics', seconds=app.config['STATISTICS_FLUSH_INTERVAL_SECONDS'])
+def flush_statistics_job():
+    with scheduler.app.app_context():
+        flush_statistics()
+
+
+@scheduler.task('interval', id='snapshot_statistics', minutes=app.config['METRICS_SNAPSHOT_INTERVAL_MINUTES'])
+def snapshot_statistics_job():
+    with scheduler.app.app_context():
+        snapshot_statistics()
+
+
+@scheduler.task('cron', id='collect_statistics', hour=app.config['STATISTICS_RECONCILIATION_HOUR'])
+def collect_statistics_job():
+    with scheduler.app.app_context():
+        collect_statistics()
+
+
+@scheduler.task('interval', id='archive_inactive_users', minutes=app.config['USER_STATUSES_UPDATE_INTERVAL_MINUTES'])
+def archive_inactive_users_job():
+    with scheduler.app.app_context():
+        archive_inactive_users()
+
+
+@scheduler.task('interval', id='collect_garbage', minutes=app.config['GARBAGE_COLLECTION_INTERVAL_MINUTES'])
+def collect_garbage_job():
+    with scheduler.app.app_context():
+        collect_garbage()
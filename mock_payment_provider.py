@@ -0,0 +1,63 @@
+import argparse
+import json
+import random
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from uuid import uuid4
+
+
+class MockPaymentProviderHandler(BaseHTTPRequestHandler):
+    """
+    Implements `POST /payments` as expected by HTTPPaymentGatewayBackend.
+    The payment link points to the callback url, so the payment is "completed" by following it.
+    """
+    protocol_version = 'HTTP/1.1'
+    delay = 0
+    failure_rate = 0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.rstrip('/').split('/')[-1] != 'payments':
+            return self.respond(404, {'error': 'Not found'})
+        if self.delay:
+            time.sleep(self.delay)
+        if random.random() < self.failure_rate:
+            return self.respond(500, {'error': 'Provider failure'})
+        try:
+            data = json.loads(body)
+            callback_url = data['callback_url']
+        except (ValueError, KeyError, TypeError):
+            return self.respond(400, {'error': 'Bad request'})
+        self.respond(200, {'payment_id': uuid4().hex, 'payment_link': callback_url})
+
+    def respond(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local mock of the payment provider for tests and benchmarks')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--delay', type=float, default=0, help='Seconds to wait before responding')
+    parser.add_argument('--failure-rate', type=float, default=0, help='Share of requests answered with 500')
+    args = parser.parse_args()
+    MockPaymentProviderHandler.delay = args.delay
+    MockPaymentProviderHandler.failure_rate = args.failure_rate
+    server = ThreadingHTTPServer((args.host, args.port), MockPaymentProviderHandler)
+    print('Mock payment provider on http://{}:{}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
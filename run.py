@@ -1,5 +1,7 @@
-from ip_app import app, scheduler
+from ip_app import app, scheduler, start_job_workers
 
 if __name__ == '__main__':
     scheduler.start()
+    if app.config['JOB_WORKERS_IN_WEB_PROCESS']:
+        start_job_workers()
     app.run(debug=True, host='0.0.0.0', port=5000)
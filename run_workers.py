@@ -0,0 +1,15 @@
+import argparse
+
+from ip_app import run_job_workers
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run background job workers')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of worker threads (JOB_WORKERS by default)')
+    args = parser.parse_args()
+    run_job_workers(args.workers)
+
+
+if __name__ == '__main__':
+    main()
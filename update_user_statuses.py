@@ -1,15 +1,18 @@
-from ip_app import *
-from ip_app.models import *
+import argparse
+
+from ip_app import app, archive_inactive_users
 
 
 def main():
-    pass
-    # for user in session.query(User).join(
-    #     Access,
-    # ).group_by(
-    #     db.coa
-    # ):
-    #     access.
+    parser = argparse.ArgumentParser(description='Move users without active access to ARCHIVED')
+    parser.add_argument('-b', '--batch-size', type=int, default=None,
+                        help='Users per batch (MAINTENANCE_BATCH_SIZE by default)')
+    args = parser.parse_args()
+    with app.app_context():
+        report = archive_inactive_users(args.batch_size)
+    for i, (changed, seconds) in enumerate(report, 1):
+        print('batch {}: {} users archived in {:.3f}s'.format(i, changed, seconds))
+    print('total: {} users archived in {:.3f}s'.format(sum(x[0] for x in report), sum(x[1] for x in report)))
 
 
 if __name__ == '__main__':